@@ -24,6 +24,11 @@ TEST = 2
 COLORS = np.array([[0, 0, 0], [0, 128, 0], [0, 0, 128], [192, 224, 224]]) # RGB
 LABELS = np.array([0, 1, 1, 2]) # Give high weight to the boundary
 
+# Lookup table mapping every label to its color (later entries take precedence for labels with multiple colors)
+PALETTE = np.zeros((256, 3), dtype=np.uint8)
+for color, label in zip(COLORS, LABELS):
+	PALETTE[label] = color
+
 # Command line options
 parser = OptionParser()
 
@@ -279,15 +284,10 @@ def writeMaskToImage(img, rowMask, colMask, directory, fileName, append='', over
 			print ("Saving predicted segmentation mask:", outputFileName)
 
 		if img is not None:
-			rgbMask = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.float32)
-			for color, label in zip(COLORS, LABELS):
-				binaryMap = mask[:, :, 0] == label
-				rgbMask[binaryMap, 0] = color[0]
-				rgbMask[binaryMap, 1] = color[1]
-				rgbMask[binaryMap, 2] = color[2]
+			rgbMask = np.take(PALETTE, mask[:, :, 0], axis=0, mode='clip') # Single gather for all the labels
 
 			if overlay:
-				rgbMask = np.uint8(cv2.addWeighted(img.astype(np.float32), 0.5, rgbMask, 0.5, 0.0))
+				cv2.addWeighted(img.astype(np.uint8), 0.5, rgbMask, 0.5, 0.0, dst=rgbMask) # Blend in-place
 
 			# Write the resulting image to file
 			cv2.imwrite(outputFileName, rgbMask)
@@ -7,9 +7,21 @@ import cv2
 import numpy as np
 from optparse import OptionParser
 import datetime as dt
+import time
+import collections
+import threading
+import hashlib
+import queue
+import json
+import re
+import contextlib
 
 import tensorflow.contrib.slim as slim
 import tensorflow as tf
+from tensorflow.python.client import timeline
+from tensorflow.python.framework import ops as tfOps
+from tensorflow.core.framework import attr_value_pb2
+from tensorflow.core.protobuf import rewriter_config_pb2
 from tensorflow.python.platform import gfile
 
 import shutil
@@ -17,12 +29,14 @@ import wget
 import tarfile
 
 # Constants
-TRAIN = 0
-VAL = 1
-TEST = 2
-
 COLORS = np.array([[0, 0, 0], [0, 128, 0], [0, 0, 128], [192, 224, 224]]) # RGB
 LABELS = np.array([0, 1, 1, 2]) # Give high weight to the boundary
+DECODER_STAGE_OUTPUTS = "decoderStageOutputs" # Collection of the decoder stage outputs (block boundaries for activation recomputation)
+
+# Lookup table mapping every label to its color (later entries take precedence for labels with multiple colors)
+PALETTE = np.zeros((256, 3), dtype=np.uint8)
+for color, label in zip(COLORS, LABELS):
+	PALETTE[label] = color
 
 # Command line options
 parser = OptionParser()
@@ -32,6 +46,11 @@ parser.add_option("-t", "--trainModel", action="store_true", dest="trainModel",
 parser.add_option("-c", "--testModel", action="store_true", dest="testModel", default=False, help="Test model")
 parser.add_option("-d", "--debug", action="store_true", dest="debug", default=False, help="Enable debugging model - high verbosity")
 parser.add_option("--tensorboardVisualization", action="store_true", dest="tensorboardVisualization", default=False, help="Enable tensorboard visualization")
+parser.add_option("--scalarSummaryStep", action="store", type="int", dest="scalarSummaryStep", default=1, help="Interval (in steps) for writing scalar summaries")
+parser.add_option("--imageSummaryStep", action="store", type="int", dest="imageSummaryStep", default=100, help="Interval (in steps) for writing image summaries")
+parser.add_option("--histogramSummaryStep", action="store", type="int", dest="histogramSummaryStep", default=1000, help="Interval (in steps) for writing weight and gradient histograms")
+parser.add_option("--summaryQueueSize", action="store", type="int", dest="summaryQueueSize", default=100, help="Number of summaries buffered before the event file writer blocks")
+parser.add_option("--summaryFlushSecs", action="store", type="int", dest="summaryFlushSecs", default=120, help="Interval (in seconds) for flushing the buffered summaries to disk")
 
 # Input Reader Params
 parser.add_option("--trainFileName", action="store", type="string", dest="trainFileName", default="./data/train.csv", help="File containing the training file names")
@@ -41,20 +60,54 @@ parser.add_option("--statsFileName", action="store", type="string", dest="statsF
 parser.add_option("--maxImageSize", action="store", type="int", dest="maxImageSize", default=2048, help="Maximum size of the larger dimension while preserving aspect ratio")
 parser.add_option("--imageChannels", action="store", type="int", dest="imageChannels", default=3, help="Number of channels in image for feeding into the network")
 parser.add_option("--shufflePerBatch", action="store_true", dest="shufflePerBatch", default=False, help="Shuffle input for every batch")
+parser.add_option("--randomSeed", action="store", type="int", dest="randomSeed", default=-1, help="Seed for shuffling the training data (-1 picks a random seed which is stored in the training state)")
 parser.add_option("--mapLabelsFromRGB", action="store_true", dest="mapLabelsFromRGB", default=False, help="Map labels from RGB to integers (if data is in form [H, W, 3])")
 parser.add_option("--useSparseLabels", action="store_true", dest="useSparseLabels", default=False, help="Use sparse labels (Mask shape: [H, W, 1] instead of [H, W, C] where C is the number of classes)")
 parser.add_option("--boundaryWeight", action="store", type="float", dest="boundaryWeight", default=10.0, help="Weight to be given to the boundary for computing the total loss")
 parser.add_option("--numParallelLoaders", action="store", type="int", dest="numParallelLoaders", default=8, help="Number of parallel loaders to be used for data loading")
+parser.add_option("--prefetchBatches", action="store", type="int", dest="prefetchBatches", default=2, help="Number of batches to prefetch while the previous batch is being processed (0 disables prefetching)")
+parser.add_option("--prefetchToDevice", action="store", type="string", dest="prefetchToDevice", default="", help="Device to which the batches are prefetched (e.g. /gpu:0), empty for host memory")
+parser.add_option("--logInputWaitTime", action="store_true", dest="logInputWaitTime", default=False, help="Log the time each training step waits for the input pipeline")
+parser.add_option("--profileTraining", action="store_true", dest="profileTraining", default=False, help="Record the per-step time split (input wait, compute, summaries, image saving) and the training throughput")
+parser.add_option("--profileWindowSize", action="store", type="int", dest="profileWindowSize", default=100, help="Number of recent steps used for the rolling profiling statistics")
+parser.add_option("--profileTraceStep", action="store", type="int", dest="profileTraceStep", default=0, help="Interval (in steps) for capturing a full trace of the training step in Chrome trace format (0 disables tracing)")
+parser.add_option("--profileTraceDir", action="store", type="string", dest="profileTraceDir", default="./traces/", help="Directory for saving the Chrome traces (open with chrome://tracing)")
+parser.add_option("--compileDataset", action="store_true", dest="compileDataset", default=False, help="Write the decoded and resized train/val/test data into sharded record files")
+parser.add_option("--useDatasetRecords", action="store_true", dest="useDatasetRecords", default=False, help="Load the data from the compiled record files instead of the original images")
+parser.add_option("--datasetRecordsDir", action="store", type="string", dest="datasetRecordsDir", default="./data/records/", help="Directory for the compiled record files")
+parser.add_option("--numRecordShards", action="store", type="int", dest="numRecordShards", default=16, help="Number of shards to be written per data file")
+parser.add_option("--recordShuffleBufferSize", action="store", type="int", dest="recordShuffleBufferSize", default=256, help="Number of records in the shuffle buffer when streaming from the record shards (the shard order is shuffled as well)")
+parser.add_option("--cacheParsedSamples", action="store_true", dest="cacheParsedSamples", default=False, help="Cache the decoded and resized samples in memory (overflow is spilled to disk)")
+parser.add_option("--cacheMemoryMB", action="store", type="int", dest="cacheMemoryMB", default=4096, help="Memory budget of the sample cache in MB")
+parser.add_option("--cacheDiskMB", action="store", type="int", dest="cacheDiskMB", default=16384, help="Disk budget of the sample cache in MB")
+parser.add_option("--cacheDir", action="store", type="string", dest="cacheDir", default="./cache/", help="Directory for spilling the sample cache to disk (cleared at startup)")
+parser.add_option("--trainCropSize", action="store", type="int", dest="trainCropSize", default=0, help="Train on random crops of the given size (0 trains on complete images)")
+parser.add_option("--minCropScale", action="store", type="float", dest="minCropScale", default=1.0, help="Minimum random rescaling of the image before cropping")
+parser.add_option("--maxCropScale", action="store", type="float", dest="maxCropScale", default=1.0, help="Maximum random rescaling of the image before cropping")
+parser.add_option("--batchLevelAugmentation", action="store_true", dest="batchLevelAugmentation", default=False, help="Apply data augmentation to the complete batch instead of every individual image")
+parser.add_option("--canonicalShapeMultiple", action="store", type="int", dest="canonicalShapeMultiple", default=0, help="Pad the images to the next multiple of the given size (e.g. 32) so that only a small set of shapes reaches the graph (0 disables padding)")
+parser.add_option("--aspectRatioBuckets", action="store", type="int", dest="aspectRatioBuckets", default=0, help="Number of aspect ratio buckets per orientation for batching images of different sizes (0 disables bucketing)")
 
 # Trainer Params
 parser.add_option("--learningRate", action="store", type="float", dest="learningRate", default=1e-4, help="Learning rate")
 parser.add_option("--weightDecayLambda", action="store", type="float", dest="weightDecayLambda", default=5e-5, help="Weight Decay Lambda")
 parser.add_option("--trainingEpochs", action="store", type="int", dest="trainingEpochs", default=5, help="Training epochs")
 parser.add_option("--batchSize", action="store", type="int", dest="batchSize", default=1, help="Batch size")
+parser.add_option("--numReplicas", action="store", type="int", dest="numReplicas", default=1, help="Number of model replicas for synchronous data-parallel training (each replica trains on its own shard of the training data)")
+parser.add_option("--replicaDeviceType", action="store", dest="replicaDeviceType", default="gpu", choices=["gpu", "cpu"], help="Device type for the replicas (cpu creates one CPU device per replica, useful for testing)")
+parser.add_option("--gradientAccumulationSteps", action="store", type="int", dest="gradientAccumulationSteps", default=1, help="Number of micro-steps over which the gradients are accumulated before applying them (effective batch size: batchSize * gradientAccumulationSteps)")
 parser.add_option("--displayStep", action="store", type="int", dest="displayStep", default=5, help="Progress display step")
 parser.add_option("--saveStep", action="store", type="int", dest="saveStep", default=1000, help="Progress save step")
-parser.add_option("--evaluateStep", action="store", type="int", dest="evaluateStep", default=100000, help="Progress evaluation step")
-parser.add_option("--evaluateStepDontSaveImages", action="store_true", dest="evaluateStepDontSaveImages", default=False, help="Don't save images on evaluate step")
+parser.add_option("--maxCheckpointsToKeep", action="store", type="int", dest="maxCheckpointsToKeep", default=5, help="Number of recent step checkpoints to keep")
+parser.add_option("--keepCheckpointEveryNHours", action="store", type="float", dest="keepCheckpointEveryNHours", default=10000.0, help="Additionally keep one step checkpoint for every N hours of training")
+parser.add_option("--evaluateStep", action="store", type="int", dest="evaluateStep", default=100000, help="Progress evaluation step (lightweight validation used for model selection, 0 evaluates only at the end of every epoch)")
+parser.add_option("--evaluateStepDontSaveImages", action="store_true", dest="evaluateStepDontSaveImages", default=False, help="Don't save images on evaluate step (also skips the image dumps of the validation pass at the end of every epoch)")
+parser.add_option("--evaluateSubsetSize", action="store", type="int", dest="evaluateSubsetSize", default=0, help="Number of validation images (fixed subset) used for the lightweight evaluation (0 uses the complete validation set)")
+parser.add_option("--bestModelMetric", action="store", dest="bestModelMetric", default="mIoU", choices=["mIoU", "loss"], help="Validation metric used for selecting the best model")
+parser.add_option("--bestModelName", action="store", type="string", dest="bestModelName", default="BestModel", help="Name to be used for saving the best model")
+parser.add_option("--earlyStoppingPatience", action="store", type="int", dest="earlyStoppingPatience", default=0, help="Stop training after the given number of evaluations without improvement (0 disables early stopping)")
+parser.add_option("--numImageWriters", action="store", type="int", dest="numImageWriters", default=2, help="Number of background threads for writing the output images (0 writes synchronously)")
+parser.add_option("--imageWriterQueueSize", action="store", type="int", dest="imageWriterQueueSize", default=16, help="Maximum number of pending output images before blocking")
 parser.add_option("--trainImagesOutputDirectory", action="store", type="string", dest="trainImagesOutputDirectory", default="./outputImages_train", help="Directory for saving output images for train set")
 parser.add_option("--valImagesOutputDirectory", action="store", type="string", dest="valImagesOutputDirectory", default="./outputImages_val", help="Directory for saving output images for validation set")
 parser.add_option("--testImagesOutputDirectory", action="store", type="string", dest="testImagesOutputDirectory", default="./outputImages_test", help="Directory for saving output images for test set")
@@ -71,13 +124,46 @@ parser.add_option("-s", "--startTrainingFromScratch", action="store_true", dest=
 parser.add_option("--numClasses", action="store", type="int", dest="numClasses", default=3, help="Number of classes")
 parser.add_option("--ignoreLabel", action="store", type="int", dest="ignoreLabel", default=255, help="Label to ignore for loss computation")
 parser.add_option("--useSkipConnections", action="store_true", dest="useSkipConnections", default=False, help="Use skip connections or not")
+parser.add_option("--decoderFilters", action="store", type="string", dest="decoderFilters", default="256,256,256,256", help="Number of filters for every decoder stage (comma separated, every stage upsamples by a factor of 2)")
+parser.add_option("--decoderSkipEndPoints", action="store", type="string", dest="decoderSkipEndPoints", default="Mixed_6a,MaxPool_5a_3x3,Conv2d_4a_3x3,Conv2d_2b_3x3", help="Encoder end points used as skip connections for the decoder stages (comma separated in stage order, empty entries skip a stage)")
+parser.add_option("--decoderSeparableConvs", action="store_true", dest="decoderSeparableConvs", default=False, help="Use depthwise separable convolutions for the 3x3 decoder convolutions")
+parser.add_option("--decoderOutputStride", action="store", type="int", dest="decoderOutputStride", default=1, help="Resolution (input size / stride) at which the decoder predicts the logits which are bilinearly upsampled to the input size")
+parser.add_option("--reportDecoderCost", action="store_true", dest="reportDecoderCost", default=False, help="Report the FLOPs (per layer) and the latency of the decoder configuration for an image of size maxImageSize")
+parser.add_option("--tiledInference", action="store_true", dest="tiledInference", default=False, help="Evaluate the test set at full resolution using overlapping tiles")
+parser.add_option("--tileSize", action="store", type="int", dest="tileSize", default=1024, help="Size of the tiles for tiled inference")
+parser.add_option("--tileOverlap", action="store", type="int", dest="tileOverlap", default=128, help="Overlap between neighboring tiles for tiled inference")
+parser.add_option("--tileBatchSize", action="store", type="int", dest="tileBatchSize", default=4, help="Number of tiles (possibly from different images) processed together")
+parser.add_option("--mixedPrecision", action="store_true", dest="mixedPrecision", default=False, help="Run the encoder and decoder in reduced precision (master weights and loss are kept in float32)")
+parser.add_option("--mixedPrecisionType", action="store", dest="mixedPrecisionType", default="auto", choices=["auto", "float16", "bfloat16"], help="Reduced precision type (auto: float16 if a GPU is available, bfloat16 otherwise)")
+parser.add_option("--initialLossScale", action="store", type="float", dest="initialLossScale", default=2.0**15, help="Initial loss scale for float16 training (dynamically adjusted)")
+parser.add_option("--lossScaleIncrementSteps", action="store", type="int", dest="lossScaleIncrementSteps", default=2000, help="Number of steps without overflow after which the loss scale is increased")
+parser.add_option("--freezeEncoder", action="store_true", dest="freezeEncoder", default=False, help="Only train the decoder (the encoder weights are kept fixed)")
+parser.add_option("--cacheEncoderFeatures", action="store_true", dest="cacheEncoderFeatures", default=False, help="Cache the encoder features computed during the first epoch on disk and train the decoder from the cache afterwards (requires --freezeEncoder)")
+parser.add_option("--encoderFeatureCacheDir", action="store", type="string", dest="encoderFeatureCacheDir", default="./encoderFeatureCache", help="Directory for the encoder feature cache")
+parser.add_option("--useXLA", action="store_true", dest="useXLA", default=False, help="Compile the encoder and decoder with XLA (one compilation per input shape, best used with --canonicalShapeMultiple)")
+parser.add_option("--recomputeActivations", action="store_true", dest="recomputeActivations", default=False, help="Store the activations only at block boundaries and recompute the activations within the blocks during backprop (IncResV2 encoder and decoder stages)")
+parser.add_option("--recomputeBlockGroupSize", action="store", type="int", dest="recomputeBlockGroupSize", default=1, help="Number of consecutive blocks recomputed together (larger values store fewer block boundaries, trading more compute for less memory)")
 parser.add_option("--useCRFPostProcessing", action="store_true", dest="useCRFPostProcessing", default=False, help="Use CRF based post-processing")
 
 # Parse command line options
 (options, args) = parser.parse_args()
 
 # Verification
-assert options.batchSize == 1, "Error: Only batch size of 1 is supported due to aspect aware scaling!"
+assert (options.batchSize == 1) or (options.aspectRatioBuckets > 0) or (options.trainCropSize > 0), "Error: Batch size larger than 1 requires aspect ratio bucketing (--aspectRatioBuckets) or random crops (--trainCropSize) due to aspect aware scaling!"
+assert (not options.tiledInference) or (options.tileOverlap < options.tileSize), "Error: Tile overlap should be smaller than the tile size!"
+assert (not options.mixedPrecision) or (options.modelName == "IncResV2"), "Error: Mixed precision is only supported for the IncResV2 model!"
+assert (not options.recomputeActivations) or (options.modelName == "IncResV2"), "Error: Activation recomputation is only supported for the IncResV2 model!"
+assert (not options.cacheEncoderFeatures) or options.freezeEncoder, "Error: Encoder features can only be cached for a frozen encoder (--freezeEncoder)!"
+assert (not options.cacheEncoderFeatures) or (options.trainCropSize == 0), "Error: Encoder features can't be cached when training on random crops!"
+assert options.decoderOutputStride >= 1, "Error: Decoder output stride should be at least 1!"
+assert (not options.reportDecoderCost) or (options.modelName == "IncResV2"), "Error: Decoder cost report is only supported for the IncResV2 model!"
+assert options.recomputeBlockGroupSize >= 1, "Error: Recompute block group size should be at least 1!"
+assert options.numReplicas >= 1, "Error: Number of replicas should be at least 1!"
+assert options.recordShuffleBufferSize >= 1, "Error: Record shuffle buffer size should be at least 1!"
+assert (options.numReplicas == 1) or (options.modelName == "IncResV2"), "Error: Multiple replicas are only supported for the IncResV2 model!"
+assert (options.numReplicas == 1) or (not options.cacheEncoderFeatures), "Error: Encoder features can't be cached with multiple replicas!"
+assert options.gradientAccumulationSteps >= 1, "Error: Number of gradient accumulation steps should be at least 1!"
+assert options.minCropScale <= options.maxCropScale, "Error: Minimum crop scale should not be larger than the maximum crop scale!"
 try:
 	import pydensecrf.densecrf as dcrf
 except:
@@ -86,10 +172,21 @@ except:
 
 options.outputModelDir = os.path.join(options.outputModelDir, "trained-" + options.modelName)
 options.outputModelName = options.outputModelName + "_" + options.modelName
+options.bestModelName = options.bestModelName + "_" + options.modelName
 
 options.trainImagesOutputDirectory = os.path.join(options.outputModelDir, options.trainImagesOutputDirectory)
 options.valImagesOutputDirectory = os.path.join(options.outputModelDir, options.valImagesOutputDirectory)
 options.testImagesOutputDirectory = os.path.join(options.outputModelDir, options.testImagesOutputDirectory)
+options.encoderFeatureCacheDir = os.path.join(options.outputModelDir, options.encoderFeatureCacheDir)
+
+if options.randomSeed < 0:
+	options.randomSeed = np.random.randint(2**31 - 1)
+tf.set_random_seed(options.randomSeed) # Graph-level seed for the remaining random ops (the data augmentation uses per-sample seeds)
+
+# Decoder configuration (one entry per stage)
+decoderFilters = [int(numFilters) for numFilters in options.decoderFilters.split(',')]
+decoderSkipEndPoints = [endPointName.strip() for endPointName in options.decoderSkipEndPoints.split(',')] if options.useSkipConnections else []
+decoderSkipEndPoints = (decoderSkipEndPoints + [''] * len(decoderFilters))[:len(decoderFilters)]
 
 print (options)
 
@@ -159,12 +256,13 @@ else:
 	exit (-1)
 
 # Reads an image from a file, decodes it into a dense tensor
-def parseFunction(imgFileName, gtFileName):
+def parseFunction(imgFileName, gtFileName, resizeImages=True):
 	# TODO: Replace with decode_image (decode_image doesn't return shape)
 	# Load the original image
 	imageString = tf.read_file(imgFileName)
 	img = tf.image.decode_jpeg(imageString)
-	img = tf.image.resize_images(img, [options.maxImageSize, options.maxImageSize], preserve_aspect_ratio=True)
+	if resizeImages:
+		img = tf.image.resize_images(img, [options.maxImageSize, options.maxImageSize], preserve_aspect_ratio=True)
 	img.set_shape([None, None, options.imageChannels])
 	img = tf.cast(img, tf.float32) # Convert to float tensor
 
@@ -189,33 +287,204 @@ def parseFunction(imgFileName, gtFileName):
 				semanticMap.append(classMap)
 			mask = tf.to_float(tf.stack(semanticMap, axis=-1))
 
-	mask = tf.image.resize_images(mask, [options.maxImageSize, options.maxImageSize], method=tf.image.ResizeMethod.NEAREST_NEIGHBOR, preserve_aspect_ratio=True)
+	if resizeImages:
+		mask = tf.image.resize_images(mask, [options.maxImageSize, options.maxImageSize], method=tf.image.ResizeMethod.NEAREST_NEIGHBOR, preserve_aspect_ratio=True)
 	mask = tf.cast(mask, tf.int32) # Convert to float tensor
 
 	return imgFileName, img, mask
 
-def dataAugmentationFunction(imgFileName, img, mask):
-	with tf.name_scope('flipLR'):
-		randomVar = tf.random_uniform(maxval=2, dtype=tf.int32, shape=[]) # Random variable: two possible outcomes (0 or 1)
-		img = tf.cond(pred=tf.equal(randomVar, 0), true_fn=lambda: tf.image.flip_left_right(img), false_fn=lambda: img)
-		mask = tf.cond(pred=tf.equal(randomVar, 0), true_fn=lambda: tf.image.flip_left_right(mask), false_fn=lambda: mask)
+# LRU cache for parsed samples which are kept in memory up to a byte budget with the overflow spilled to disk
+class SampleCache(object):
+	def __init__(self, memoryBudget, diskBudget, cacheDir):
+		self.memoryBudget = memoryBudget
+		self.diskBudget = diskBudget
+		self.cacheDir = cacheDir
+		self.memoryEntries = collections.OrderedDict() # Key -> (img, mask)
+		self.diskEntries = collections.OrderedDict() # Key -> (fileName, numBytes)
+		self.memoryBytes = 0
+		self.diskBytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock() # Accessed from the parallel loaders
+
+		if os.path.exists(self.cacheDir):
+			shutil.rmtree(self.cacheDir)
+		os.makedirs(self.cacheDir)
+
+	def lookup(self, key):
+		with self.lock:
+			if key in self.memoryEntries:
+				self.memoryEntries.move_to_end(key)
+				self.hits += 1
+				img, mask = self.memoryEntries[key]
+				return np.array(True), img, mask
+
+			diskEntry = self.diskEntries.get(key)
+			if diskEntry is not None:
+				self.diskEntries.move_to_end(key)
+
+		# Read from disk without blocking the other loaders
+		if diskEntry is not None:
+			try:
+				with np.load(diskEntry[0]) as data:
+					img, mask = data['img'], data['mask']
+				with self.lock:
+					self.hits += 1
+				return np.array(True), img, mask
+			except IOError:
+				pass # Evicted in the meantime
+
+		with self.lock:
+			self.misses += 1
+		return np.array(False), np.zeros((0, 0, options.imageChannels), dtype=np.float32), np.zeros((0, 0, 1), dtype=np.int32)
+
+	def store(self, key, img, mask):
+		with self.lock:
+			if (key in self.memoryEntries) or (key in self.diskEntries):
+				return np.array(True)
+
+			self.memoryEntries[key] = (img.copy(), mask.copy()) # Inputs might share the buffer with the tensors
+			self.memoryBytes += img.nbytes + mask.nbytes
+
+			# Spill the least recently used entries to disk
+			while (self.memoryBytes > self.memoryBudget) and (len(self.memoryEntries) > 0):
+				evictedKey, (evictedImg, evictedMask) = self.memoryEntries.popitem(last=False)
+				numBytes = evictedImg.nbytes + evictedMask.nbytes
+				self.memoryBytes -= numBytes
+				if numBytes > self.diskBudget:
+					continue
+
+				fileName = os.path.join(self.cacheDir, hashlib.md5(evictedKey).hexdigest() + '.npz')
+				np.savez(fileName, img=evictedImg, mask=evictedMask)
+				self.diskEntries[evictedKey] = (fileName, numBytes)
+				self.diskBytes += numBytes
+
+				# Drop the least recently used entries from disk
+				while self.diskBytes > self.diskBudget:
+					_, (droppedFileName, droppedNumBytes) = self.diskEntries.popitem(last=False)
+					os.remove(droppedFileName)
+					self.diskBytes -= droppedNumBytes
+
+		return np.array(True)
+
+	def getStatistics(self):
+		with self.lock:
+			return "Hits: %d | Misses: %d | Memory: %d entries (%.1f MB) | Disk: %d entries (%.1f MB)" % (self.hits, self.misses, len(self.memoryEntries), 
+						self.memoryBytes / 2.0**20, len(self.diskEntries), self.diskBytes / 2.0**20)
+
+sampleCache = SampleCache(options.cacheMemoryMB * 2**20, options.cacheDiskMB * 2**20, options.cacheDir) if options.cacheParsedSamples else None
+
+# Returns the parsed sample from the cache or parses it and adds it to the cache
+def cachedParseFunction(imgFileName, gtFileName):
+	found, cachedImg, cachedMask = tf.py_func(sampleCache.lookup, [imgFileName], [tf.bool, tf.float32, tf.int32], stateful=True, name="SampleCacheLookup")
+
+	def parseAndStore():
+		_, img, mask = parseFunction(imgFileName, gtFileName)
+		stored = tf.py_func(sampleCache.store, [imgFileName, img, mask], tf.bool, stateful=True, name="SampleCacheStore")
+		with tf.control_dependencies([stored]):
+			return tf.identity(img), tf.identity(mask)
+
+	img, mask = tf.cond(tf.reshape(found, []), lambda: (cachedImg, cachedMask), parseAndStore)
+	img.set_shape([None, None, options.imageChannels])
+	mask.set_shape([None, None, None])
 
-	with tf.name_scope('flipUD'):
-		randomVar = tf.random_uniform(maxval=2, dtype=tf.int32, shape=[]) # Random variable: two possible outcomes (0 or 1)
-		img = tf.cond(pred=tf.equal(randomVar, 0), true_fn=lambda: tf.image.flip_up_down(img), false_fn=lambda: img)
-		mask = tf.cond(pred=tf.equal(randomVar, 0), true_fn=lambda: tf.image.flip_up_down(mask), false_fn=lambda: mask)
+	return imgFileName, img, mask
 
-	img = tf.image.random_brightness(img, max_delta=32.0 / 255.0)
-	img = tf.image.random_saturation(img, lower=0.5, upper=1.5)
+# Seed of the stateless random ops for a sample which only depends on the file name, the epoch seed and the augmentation step (reproducible when resuming mid-epoch)
+def getSampleSeed(imgFileName, augmentationSeed, salt):
+	return tf.stack([tf.string_to_hash_bucket_fast(tf.string_join([imgFileName, salt], separator='/'), 2**62), tf.cast(augmentationSeed, tf.int64)])
+
+def statelessRandomUniform(shape, seed, minval=0.0, maxval=1.0):
+	return minval + (maxval - minval) * tf.contrib.stateless.stateless_random_uniform(shape, seed=seed)
+
+# Takes an aligned random crop of the image and the mask with optional multi-scale jitter
+def randomCropFunction(imgFileName, img, mask, augmentationSeed):
+	with tf.name_scope('randomCrop'):
+		if (options.minCropScale != 1.0) or (options.maxCropScale != 1.0):
+			scale = statelessRandomUniform([], getSampleSeed(imgFileName, augmentationSeed, 'scale'), minval=options.minCropScale, maxval=options.maxCropScale)
+			scaledSize = tf.to_int32(tf.round(tf.to_float(tf.shape(img)[:2]) * scale))
+			img = tf.image.resize_images(img, scaledSize)
+			mask = tf.image.resize_images(mask, scaledSize, method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+
+		# Pad images smaller than the crop size (padded mask pixels are set to the ignore label)
+		combined = tf.concat([img, tf.to_float(tf.cast(mask, tf.int32) - options.ignoreLabel)], axis=-1)
+		combinedShape = tf.shape(combined)
+		combined = tf.image.pad_to_bounding_box(combined, 0, 0, tf.maximum(combinedShape[0], options.trainCropSize), tf.maximum(combinedShape[1], options.trainCropSize))
+		combinedShape = tf.shape(combined)
+		maxOffsets = combinedShape[:2] - options.trainCropSize
+		offsets = tf.minimum(tf.to_int32(statelessRandomUniform([2], getSampleSeed(imgFileName, augmentationSeed, 'crop')) * tf.to_float(maxOffsets + 1)), maxOffsets)
+		combined = tf.slice(combined, tf.concat([offsets, [0]], axis=0), tf.concat([[options.trainCropSize, options.trainCropSize], combinedShape[2:]], axis=0))
+
+		img, mask = tf.split(combined, [options.imageChannels, -1], axis=-1)
+		mask = tf.cast(mask, tf.int32) + options.ignoreLabel
+		img.set_shape([options.trainCropSize, options.trainCropSize, options.imageChannels])
+		mask.set_shape([options.trainCropSize, options.trainCropSize, None])
+
+	return imgFileName, img, mask
+
+# Flips the image and the mask jointly with a single reverse op over the randomly selected spatial axes
+def randomFlipFunction(img, mask, spatialAxes, seed):
+	with tf.name_scope('randomFlip'):
+		combined = tf.concat([img, tf.cast(mask, tf.float32)], axis=-1) # Labels are exactly representable in float32
+		randomVars = statelessRandomUniform([2], seed) # Random variables for flipping UD and LR: two possible outcomes (flipped below 0.5)
+		flipAxes = tf.boolean_mask(tf.constant(spatialAxes, dtype=tf.int32), tf.less(randomVars, 0.5))
+		combined = tf.reverse(combined, axis=flipAxes)
+		img, mask = tf.split(combined, [options.imageChannels, -1], axis=-1)
+
+	return img, tf.cast(mask, tf.int32)
+
+def colorAugmentationFunction(img, seed):
+	randomVars = statelessRandomUniform([2], seed)
+	img = tf.image.adjust_brightness(img, (2.0 * randomVars[0] - 1.0) * 32.0 / 255.0)
+	img = tf.image.adjust_saturation(img, 0.5 + randomVars[1])
 
 	# Make sure the image is still in [0, 255]
 	img = tf.clip_by_value(img, 0.0, 255.0)
 
+	return img
+
+def dataAugmentationFunction(imgFileName, img, mask, augmentationSeed):
+	img, mask = randomFlipFunction(img, mask, spatialAxes=[0, 1], seed=getSampleSeed(imgFileName, augmentationSeed, 'flip'))
+	img = colorAugmentationFunction(img, seed=getSampleSeed(imgFileName, augmentationSeed, 'color'))
+
 	return imgFileName, img, mask
 
-def loadDataset(currentDataFile, dataAugmentation=False):
-	print ("Loading data from file: %s" % (currentDataFile))
-	dataClasses = {}
+# Pads the image (and the mask with the ignore label) to the next multiple of canonicalShapeMultiple
+# Padded pixels are excluded from the loss and the metrics through the ignore label
+def padToCanonicalShapeFunction(imgFileName, img, mask):
+	with tf.name_scope('padToCanonicalShape'):
+		imgShape = tf.shape(img)
+		paddedHeight = ((imgShape[0] + options.canonicalShapeMultiple - 1) // options.canonicalShapeMultiple) * options.canonicalShapeMultiple
+		paddedWidth = ((imgShape[1] + options.canonicalShapeMultiple - 1) // options.canonicalShapeMultiple) * options.canonicalShapeMultiple
+		img = tf.image.pad_to_bounding_box(img, 0, 0, paddedHeight, paddedWidth)
+		mask = tf.image.pad_to_bounding_box(tf.cast(mask, tf.int32) - options.ignoreLabel, 0, 0, paddedHeight, paddedWidth) + options.ignoreLabel
+
+	return imgFileName, img, mask
+
+# Augments the complete batch at once (all images in the batch share the same random transformation)
+def batchAugmentationFunction(imgFileNames, imgs, masks, augmentationSeed):
+	# The seed of the batch is derived from its first image
+	imgs, masks = randomFlipFunction(imgs, masks, spatialAxes=[1, 2], seed=getSampleSeed(imgFileNames[0], augmentationSeed, 'flip'))
+	imgs = colorAugmentationFunction(imgs, seed=getSampleSeed(imgFileNames[0], augmentationSeed, 'color'))
+
+	return imgFileNames, imgs, masks
+
+# Assigns the image to a bucket based on its orientation and the length of its shorter side after resizing
+def bucketKeyFunction(imgFileName, img, mask):
+	imgShape = tf.shape(img)
+	shortSide = tf.minimum(imgShape[0], imgShape[1])
+	ratioBin = tf.minimum((shortSide * options.aspectRatioBuckets) // options.maxImageSize, options.aspectRatioBuckets - 1)
+	isPortrait = tf.cast(imgShape[0] > imgShape[1], tf.int32)
+	return tf.to_int64(isPortrait * options.aspectRatioBuckets + ratioBin)
+
+# Pads the images within a bucket to the largest image (mask padding is ignored in the loss)
+def bucketReduceFunction(key, bucketDataset, batchSize):
+	paddedShapes = (tf.TensorShape([]), tf.TensorShape([None, None, options.imageChannels]), tf.TensorShape([None, None, None]))
+	paddingValues = (tf.constant('', dtype=tf.string), tf.constant(0.0, dtype=tf.float32), tf.constant(options.ignoreLabel, dtype=tf.int32))
+	return bucketDataset.padded_batch(batchSize, padded_shapes=paddedShapes, padding_values=paddingValues)
+
+# Reads the image and mask file names from the CSV file
+def readDataFileNames(currentDataFile):
 	with open(currentDataFile) as f:
 		imageFileNames = f.readlines()
 		originalImageNames = []
@@ -226,25 +495,166 @@ def loadDataset(currentDataFile, dataAugmentation=False):
 			originalImageNames.append(imName[0])
 			maskImageNames.append(imName[1])
 
-		originalImageNames = tf.constant(originalImageNames)
-		maskImageNames = tf.constant(maskImageNames)
+	return originalImageNames, maskImageNames
+
+# Records are specific to the data file as well as the image size
+def getRecordFileName(currentDataFile, shardIndex, numShards):
+	dataFileRoot, _ = os.path.splitext(os.path.basename(currentDataFile))
+	return os.path.join(options.datasetRecordsDir, "%s-%d-%05d-of-%05d.tfrecord" % (dataFileRoot, options.maxImageSize, shardIndex, numShards))
+
+def getRecordFileNames(currentDataFile):
+	dataFileRoot, _ = os.path.splitext(os.path.basename(currentDataFile))
+	return sorted(gfile.Glob(os.path.join(options.datasetRecordsDir, "%s-%d-*-of-*.tfrecord" % (dataFileRoot, options.maxImageSize))))
+
+def int64Feature(value):
+	return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+def bytesFeature(value):
+	return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+# Decodes and resizes every image once and writes the raw uint8 image and mask (with their shapes) into record shards
+def compileDataset(currentDataFile):
+	print ("Compiling data from file: %s" % (currentDataFile))
+	originalImageNames, maskImageNames = readDataFileNames(currentDataFile)
+	numFiles = len(originalImageNames)
+	numShards = max(1, min(options.numRecordShards, numFiles))
+	if not os.path.exists(options.datasetRecordsDir):
+		os.makedirs(options.datasetRecordsDir)
+
+	with tf.Graph().as_default():
+		dataset = tf.data.Dataset.from_tensor_slices((tf.constant(originalImageNames), tf.constant(maskImageNames)))
+		dataset = dataset.map(cachedParseFunction if options.cacheParsedSamples else parseFunction, num_parallel_calls=options.numParallelLoaders)
+		dataset = dataset.map(lambda imgFileName, img, mask: (imgFileName, tf.cast(tf.round(tf.clip_by_value(img, 0.0, 255.0)), tf.uint8), tf.cast(mask, tf.uint8)), num_parallel_calls=options.numParallelLoaders)
+		dataset = dataset.prefetch(options.numParallelLoaders)
+		nextElement = dataset.make_one_shot_iterator().get_next()
+
+		writers = [tf.python_io.TFRecordWriter(getRecordFileName(currentDataFile, shardIndex, numShards)) for shardIndex in range(numShards)]
+		with tf.Session() as sess:
+			iterations = 0
+			try:
+				while True:
+					imgFileName, img, mask = sess.run(nextElement)
+					example = tf.train.Example(features=tf.train.Features(feature={
+						'fileName': bytesFeature(imgFileName),
+						'height': int64Feature(img.shape[0]),
+						'width': int64Feature(img.shape[1]),
+						'maskChannels': int64Feature(mask.shape[2]),
+						'image': bytesFeature(img.tobytes()),
+						'mask': bytesFeature(mask.tobytes())}))
+					writers[iterations % numShards].write(example.SerializeToString()) # Distribute the images evenly over the shards
+					iterations += 1
 
-	numFiles = len(imageFileNames)
+			except tf.errors.OutOfRangeError:
+				print ("Compiled %d images into %d shards" % (iterations, numShards))
+
+		for writer in writers:
+			writer.close()
+
+# Reads a pre-decoded and pre-resized image and mask from a record
+def parseRecordFunction(record):
+	features = tf.parse_single_example(record, features={
+		'fileName': tf.FixedLenFeature([], tf.string),
+		'height': tf.FixedLenFeature([], tf.int64),
+		'width': tf.FixedLenFeature([], tf.int64),
+		'maskChannels': tf.FixedLenFeature([], tf.int64),
+		'image': tf.FixedLenFeature([], tf.string),
+		'mask': tf.FixedLenFeature([], tf.string)})
+
+	height = tf.cast(features['height'], tf.int32)
+	width = tf.cast(features['width'], tf.int32)
+	img = tf.reshape(tf.decode_raw(features['image'], tf.uint8), [height, width, options.imageChannels])
+	img = tf.cast(img, tf.float32) # Convert to float tensor
+
+	mask = tf.reshape(tf.decode_raw(features['mask'], tf.uint8), [height, width, tf.cast(features['maskChannels'], tf.int32)])
+	mask = tf.cast(mask, tf.int32)
+
+	return features['fileName'], img, mask
+
+# The shuffle seed and the excluded file names (already consumed in the current epoch) can be tensors in order to resume training mid-epoch
+# A fixed subset of the data can be selected using numSamples (taken before shuffling)
+# The data can be split into numShards disjoint shards (after shuffling so that the shards change every epoch)
+def loadDataset(currentDataFile, dataAugmentation=False, randomCrop=False, batchSize=1, resizeImages=True, shuffleSeed=None, excludedFileNamesTable=None, numSamples=None, numShards=1, shardIndex=0, prefetchDevice=None):
+	print ("Loading data from file: %s" % (currentDataFile))
+	originalImageNames, maskImageNames = readDataFileNames(currentDataFile)
+
+	numFiles = len(originalImageNames)
+	if numSamples is not None:
+		numFiles = min(numFiles, numSamples)
 	print ("Dataset loaded")
 	print ("Number of files found: %d" % (numFiles))
 
-	dataset = tf.data.Dataset.from_tensor_slices((originalImageNames, maskImageNames))
-	dataset = dataset.map(parseFunction, num_parallel_calls=options.numParallelLoaders)
+	if options.useDatasetRecords and resizeImages:
+		recordFileNames = getRecordFileNames(currentDataFile)
+		assert len(recordFileNames) > 0, "Error: No compiled records found for %s (use --compileDataset)" % (currentDataFile)
+		print ("Streaming data from %d record shards" % (len(recordFileNames)))
+
+		# Read the shards in parallel in random order (deterministic order when the order has to be reproducible)
+		dataset = tf.data.Dataset.from_tensor_slices(tf.constant(recordFileNames))
+		if options.shufflePerBatch:
+			dataset = dataset.shuffle(buffer_size=len(recordFileNames), seed=shuffleSeed)
+		dataset = dataset.apply(tf.contrib.data.parallel_interleave(tf.data.TFRecordDataset, cycle_length=min(options.numParallelLoaders, len(recordFileNames)), sloppy=options.shufflePerBatch and (shuffleSeed is None) and (numSamples is None)))
+		getFileName = lambda record: tf.parse_single_example(record, features={'fileName': tf.FixedLenFeature([], tf.string)})['fileName']
+		currentParseFunction = parseRecordFunction
+		shuffleBufferSize = min(numFiles, options.recordShuffleBufferSize) # Records contain the decoded images (bounded buffer)
+	else:
+		dataset = tf.data.Dataset.from_tensor_slices((tf.constant(originalImageNames), tf.constant(maskImageNames)))
+		getFileName = lambda imgFileName, gtFileName: imgFileName
+		if not resizeImages:
+			currentParseFunction = lambda imgFileName, gtFileName: parseFunction(imgFileName, gtFileName, resizeImages=False)
+		elif options.cacheParsedSamples:
+			currentParseFunction = cachedParseFunction
+		else:
+			currentParseFunction = parseFunction
+		shuffleBufferSize = numFiles
 
-	# Data augmentation
-	if dataAugmentation:
-		dataset = dataset.map(dataAugmentationFunction, num_parallel_calls=options.numParallelLoaders)
+	if numSamples is not None:
+		dataset = dataset.take(numSamples)
 
-	# Data shuffling
+	# Data shuffling (performed on the file names/records before decoding)
 	if options.shufflePerBatch:
-		dataset = dataset.shuffle(buffer_size=numFiles)
+		dataset = dataset.shuffle(buffer_size=shuffleBufferSize, seed=shuffleSeed)
+
+	# Skip the images which have already been consumed without decoding them (the table maps the file names to the shuffle seed of the epoch in which they were consumed)
+	if excludedFileNamesTable is not None:
+		dataset = dataset.filter(lambda *args: tf.not_equal(excludedFileNamesTable.lookup(getFileName(*args)), tf.cast(shuffleSeed, tf.int64)))
+
+	if numShards > 1:
+		dataset = dataset.shard(numShards, shardIndex)
+
+	# Random cropping and data augmentation (fused with parsing into a single map)
+	augmentationSeed = shuffleSeed if shuffleSeed is not None else options.randomSeed
+	if randomCrop:
+		parseAndCropFunction = lambda *args: randomCropFunction(*currentParseFunction(*args), augmentationSeed=augmentationSeed)
+	else:
+		parseAndCropFunction = currentParseFunction
+
+	if dataAugmentation and not options.batchLevelAugmentation:
+		prepareFunction = lambda *args: dataAugmentationFunction(*parseAndCropFunction(*args), augmentationSeed=augmentationSeed)
+	else:
+		prepareFunction = parseAndCropFunction
 
-	dataset = dataset.batch(options.batchSize)
+	# Snap the images to canonical shapes (tiled inference already uses fixed size tiles)
+	if (options.canonicalShapeMultiple > 0) and resizeImages:
+		dataset = dataset.map(lambda *args: padToCanonicalShapeFunction(*prepareFunction(*args)), num_parallel_calls=options.numParallelLoaders)
+	else:
+		dataset = dataset.map(prepareFunction, num_parallel_calls=options.numParallelLoaders)
+
+	# Group images with similar aspect ratio into the same batch (crops already have a fixed size)
+	if (options.aspectRatioBuckets > 0) and not randomCrop:
+		dataset = dataset.apply(tf.contrib.data.group_by_window(key_func=bucketKeyFunction, reduce_func=lambda key, bucketDataset: bucketReduceFunction(key, bucketDataset, batchSize), window_size=batchSize))
+	else:
+		dataset = dataset.batch(batchSize)
+
+	if dataAugmentation and options.batchLevelAugmentation:
+		dataset = dataset.map(lambda *args: batchAugmentationFunction(*args, augmentationSeed=augmentationSeed), num_parallel_calls=options.numParallelLoaders)
+
+	# Overlap the preparation of the next batches with the computation on the current batch
+	if prefetchDevice is None:
+		prefetchDevice = options.prefetchToDevice
+	if prefetchDevice != "":
+		dataset = dataset.apply(tf.contrib.data.copy_to_device(prefetchDevice))
+	if options.prefetchBatches > 0:
+		dataset = dataset.prefetch(options.prefetchBatches)
 
 	return dataset
 
@@ -258,94 +668,422 @@ def writeMaskToImage(img, mask, directory, fileName, append='', overlay=True):
 	if options.debug:
 		print ("Saving predicted segmentation mask:", outputFileName)
 
-	rgbMask = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.float32)
-	for color, label in zip(COLORS, LABELS):
-		binaryMap = mask[:, :, 0] == label
-		rgbMask[binaryMap, 0] = color[0]
-		rgbMask[binaryMap, 1] = color[1]
-		rgbMask[binaryMap, 2] = color[2]
+	rgbMask = np.take(PALETTE, mask[:, :, 0], axis=0, mode='clip') # Single gather for all the labels
 
 	if overlay:
-		rgbMask = np.uint8(cv2.addWeighted(img.astype(np.float32), 0.5, rgbMask, 0.5, 0.0))
+		cv2.addWeighted(img.astype(np.uint8), 0.5, rgbMask, 0.5, 0.0, dst=rgbMask) # Blend in-place
 
 	# Write the resulting image to file
 	cv2.imwrite(outputFileName, rgbMask)
 
+# Same as the on-graph confusion matrix (used when the predictions are computed on the host)
+def computeConfusionMatrix(predMask, gtMask):
+	labels = gtMask.reshape(-1).astype(np.int64)
+	predictions = predMask.reshape(-1).astype(np.int64)
+	validPixels = labels != options.ignoreLabel
+	indices = labels[validPixels] * options.numClasses + predictions[validPixels]
+	return np.bincount(indices, minlength=options.numClasses * options.numClasses).reshape(options.numClasses, options.numClasses)
+
+# Computes the segmentation metrics from the confusion matrix (classes which never occur are excluded from the mean)
+def computeSegmentationMetrics(confusionMatrix):
+	confusionMatrix = confusionMatrix.astype(np.float64)
+	truePositives = np.diag(confusionMatrix)
+	gtPixels = np.sum(confusionMatrix, axis=1)
+	predictedPixels = np.sum(confusionMatrix, axis=0)
+	totalPixels = max(np.sum(confusionMatrix), 1.0)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		classIoU = truePositives / (gtPixels + predictedPixels - truePositives)
+		classF1 = 2.0 * truePositives / (gtPixels + predictedPixels)
+
+	frequencies = gtPixels / totalPixels
+	metrics = {}
+	metrics['pixelAccuracy'] = np.sum(truePositives) / totalPixels
+	metrics['classIoU'] = classIoU
+	metrics['classF1'] = classF1
+	metrics['meanIoU'] = np.nanmean(classIoU) if np.any(~np.isnan(classIoU)) else 0.0
+	metrics['frequencyWeightedIoU'] = np.sum(frequencies[frequencies > 0] * classIoU[frequencies > 0])
+	return metrics
+
+def printSegmentationMetrics(setName, metrics):
+	print ("%s | mIoU: %f | Pixel accuracy: %f | Frequency weighted IoU: %f" % (setName, metrics['meanIoU'], metrics['pixelAccuracy'], metrics['frequencyWeightedIoU']))
+	for classIdx in range(options.numClasses):
+		print ("%s | Class: %d | IoU: %f | F1: %f" % (setName, classIdx, metrics['classIoU'][classIdx], metrics['classF1'][classIdx]))
+
+# Writes the output images using a pool of background threads (OpenCV releases the GIL while encoding and writing)
+# The queue is bounded so that the training/evaluation loop blocks when the writers can't keep up
+class AsyncMaskWriter(object):
+	def __init__(self, numWriters, queueSize):
+		self.numWriters = numWriters
+		self.jobQueue = queue.Queue(maxsize=queueSize)
+		self.errors = []
+		self.threads = []
+		for _ in range(numWriters):
+			thread = threading.Thread(target=self.run)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def run(self):
+		while True:
+			job = self.jobQueue.get()
+			try:
+				if job is None: # Shutdown
+					return
+				args, kwargs = job
+				writeMaskToImage(*args, **kwargs)
+			except Exception as e:
+				self.errors.append(e)
+			finally:
+				self.jobQueue.task_done()
+
+	# Same arguments as writeMaskToImage
+	def write(self, *args, **kwargs):
+		if self.numWriters == 0:
+			writeMaskToImage(*args, **kwargs)
+		else:
+			self.jobQueue.put((args, kwargs)) # Blocks if the queue is full
+
+	# Waits until all the pending images have been written
+	def flush(self):
+		self.jobQueue.join()
+		if len(self.errors) > 0:
+			errors, self.errors = self.errors, []
+			raise errors[0]
+
+	def close(self):
+		self.flush()
+		for _ in self.threads:
+			self.jobQueue.put(None)
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+		self.numWriters = 0
+
+maskWriter = AsyncMaskWriter(options.numImageWriters, options.imageWriterQueueSize)
+
+# Predicts the logits of arbitrarily large images using overlapping tiles which are blended together
+# Tiles from different images are batched together, so several images might be in flight at the same time
+class TiledInferenceEngine(object):
+	def __init__(self, sess, inputTensor, logitsTensor, tileSize, tileOverlap, tileBatchSize, feedDict=None):
+		self.sess = sess
+		self.inputTensor = inputTensor
+		self.logitsTensor = logitsTensor
+		self.tileSize = tileSize
+		self.tileOverlap = tileOverlap
+		self.tileBatchSize = tileBatchSize
+		self.feedDict = feedDict if feedDict is not None else {}
+
+		self.pendingTiles = [] # (image entry, y, x, tile)
+		self.inFlightImages = collections.OrderedDict() # Image ID -> image entry
+		self.nextImageID = 0
+
+		# Blending weights decrease linearly within the overlapping region
+		ramp = np.minimum(np.arange(tileSize) + 1, np.arange(tileSize)[::-1] + 1)
+		ramp = np.minimum(ramp, tileOverlap + 1).astype(np.float32) / (tileOverlap + 1)
+		self.blendingWeights = np.outer(ramp, ramp)
+
+	def getTilePositions(self, length):
+		stride = self.tileSize - self.tileOverlap
+		positions = list(range(0, max(length - self.tileSize, 0) + 1, stride))
+		if positions[-1] + self.tileSize < length:
+			positions.append(length - self.tileSize)
+		return positions
+
+	# Adds an image ([H, W, C]) and returns the list of (payload, logits) of the completed images
+	def addImage(self, img, payload=None):
+		height, width = img.shape[0], img.shape[1]
+		imageEntry = {'id': self.nextImageID, 'payload': payload, 'height': height, 'width': width, 'remainingTiles': 0, 
+						'logits': None, 'weights': np.zeros((height, width), dtype=np.float32)}
+		self.inFlightImages[self.nextImageID] = imageEntry
+		self.nextImageID += 1
+
+		for y in self.getTilePositions(height):
+			for x in self.getTilePositions(width):
+				tile = np.zeros((self.tileSize, self.tileSize, img.shape[2]), dtype=np.float32) # Zero padding for images smaller than the tile size
+				tileHeight, tileWidth = min(self.tileSize, height - y), min(self.tileSize, width - x)
+				tile[:tileHeight, :tileWidth] = img[y:y+tileHeight, x:x+tileWidth]
+				self.pendingTiles.append((imageEntry, y, x, tile))
+				imageEntry['remainingTiles'] += 1
+
+		completedImages = []
+		while len(self.pendingTiles) >= self.tileBatchSize:
+			completedImages += self.processTiles(self.tileBatchSize)
+		return completedImages
+
+	# Processes the remaining tiles and returns the list of (payload, logits) of the completed images
+	def flush(self):
+		completedImages = []
+		while len(self.pendingTiles) > 0:
+			completedImages += self.processTiles(min(self.tileBatchSize, len(self.pendingTiles)))
+		return completedImages
+
+	def processTiles(self, numTiles):
+		tiles, self.pendingTiles = self.pendingTiles[:numTiles], self.pendingTiles[numTiles:]
+		feedDict = dict(self.feedDict)
+		feedDict[self.inputTensor] = np.stack([tile for _, _, _, tile in tiles], axis=0)
+		tileLogits = self.sess.run(self.logitsTensor, feed_dict=feedDict)
+
+		for (imageEntry, y, x, _), logits in zip(tiles, tileLogits):
+			if imageEntry['logits'] is None:
+				imageEntry['logits'] = np.zeros((imageEntry['height'], imageEntry['width'], logits.shape[-1]), dtype=np.float32)
+			tileHeight, tileWidth = min(self.tileSize, imageEntry['height'] - y), min(self.tileSize, imageEntry['width'] - x)
+			weights = self.blendingWeights[:tileHeight, :tileWidth]
+			imageEntry['logits'][y:y+tileHeight, x:x+tileWidth] += logits[:tileHeight, :tileWidth] * weights[:, :, np.newaxis]
+			imageEntry['weights'][y:y+tileHeight, x:x+tileWidth] += weights
+			imageEntry['remainingTiles'] -= 1
+
+		# Images are returned in the order in which they were added
+		completedImages = []
+		while (len(self.inFlightImages) > 0) and (next(iter(self.inFlightImages.values()))['remainingTiles'] == 0):
+			_, imageEntry = self.inFlightImages.popitem(last=False)
+			logits = imageEntry['logits'] / imageEntry['weights'][:, :, np.newaxis]
+			completedImages.append((imageEntry['payload'], logits))
+		return completedImages
+
+# Runs tiled inference over the complete dataset and yields the payload (file name, image, GT mask) along with the stitched logits [1, H, W, C]
+def tiledInference(sess, datasetHandle):
+	engine = TiledInferenceEngine(sess, inputBatchImages, predictedLogits, options.tileSize, options.tileOverlap, options.tileBatchSize)
+	try:
+		while True:
+			[fileName, originalImage, gtMask] = sess.run([inputBatchImageNames, inputBatchImages, inputBatchMasks], feed_dict={datasetHandlePlaceholder: datasetHandle})
+			for payload, logits in engine.addImage(originalImage[0], payload=(fileName, originalImage, gtMask)):
+				yield payload, logits[np.newaxis]
+
+	except tf.errors.OutOfRangeError:
+		pass
+
+	for payload, logits in engine.flush():
+		yield payload, logits[np.newaxis]
+
+# Computes the cross-entropy loss on the host in the same way as the graph (see createCrossEntropyLoss)
+# Ignored pixels don't contribute, boundary pixels are weighted and the weighted sum is divided by the number of pixels with nonzero weight
+def computeCrossEntropyLoss(logits, mask):
+	logits = logits.reshape(-1, logits.shape[-1])
+	labels = mask.reshape(-1)
+	validPixels = labels != options.ignoreLabel
+	logits, labels = logits[validPixels], labels[validPixels]
+	weights = np.where(labels == 2, options.boundaryWeight, 1.0)
+	numNonzeroWeights = np.count_nonzero(weights)
+	if numNonzeroWeights == 0:
+		return 0.0
+
+	maxLogits = np.max(logits, axis=-1, keepdims=True)
+	logSumExp = np.log(np.sum(np.exp(logits - maxLogits), axis=-1)) + maxLogits[:, 0]
+	return float(np.sum(weights * (logSumExp - logits[np.arange(labels.shape[0]), labels])) / numNonzeroWeights)
+
+# Checks whether a convolution can be run in the given data type (e.g. many builds have no bfloat16 Conv2D kernel for CPU)
+def isConvolutionSupported(dtype):
+	with tf.Graph().as_default():
+		output = tf.nn.conv2d(tf.zeros([1, 4, 4, 1], dtype=dtype), tf.zeros([3, 3, 1, 1], dtype=dtype), strides=[1, 1, 1, 1], padding='SAME')
+		with tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))) as sess:
+			try:
+				sess.run(output)
+				return True
+			except (tf.errors.InvalidArgumentError, tf.errors.NotFoundError, tf.errors.UnimplementedError):
+				return False
+
+# Data type used for the computations in the encoder and the decoder
+if options.mixedPrecision:
+	if options.mixedPrecisionType == "auto":
+		computeDtype = tf.float16 if tf.test.is_gpu_available() else tf.bfloat16 # Fall back to bfloat16 for CPU (also for CUDA builds on hosts without a GPU)
+	else:
+		computeDtype = tf.float16 if options.mixedPrecisionType == "float16" else tf.bfloat16
+	if (computeDtype == tf.bfloat16) and not isConvolutionSupported(computeDtype):
+		print ("Warning: No bfloat16 convolution available on this device, falling back to float32!")
+		computeDtype = tf.float32
+	print ("Using mixed precision with compute type: %s" % (computeDtype.name))
+else:
+	computeDtype = tf.float32
+
+# Creates the variables in float32 (master weights) and casts them to the reduced precision type for the computations
+def float32VariableStorageGetter(getter, name, shape=None, dtype=None, initializer=None, regularizer=None, trainable=True, *args, **kwargs):
+	storageDtype = tf.float32 if dtype in [tf.float16, tf.bfloat16] else dtype
+	variable = getter(name, shape, dtype=storageDtype, initializer=initializer, regularizer=regularizer, trainable=trainable, *args, **kwargs)
+	if storageDtype != dtype:
+		variable = tf.cast(variable, dtype)
+	return variable
+
+variableCustomGetter = float32VariableStorageGetter if computeDtype != tf.float32 else None
+
 # TODO: Add skip connections
 # Performs the upsampling of the given images
-def attachDecoder(net, endPoints, inputShape, activation=tf.nn.relu, numFilters=256, filterSize=(3, 3), strides=(2, 2), padding='same'):
-	with tf.name_scope('Decoder'), tf.variable_scope('Decoder'):
-		out = tf.layers.conv2d_transpose(activation(net), numFilters, filterSize, strides=strides, padding='valid')
-		if options.useSkipConnections:
-			endPointName = 'Mixed_6a'
-			endPoint = endPoints[endPointName]
-			encShape = tf.shape(endPoint)
-			out = tf.image.resize_bilinear(out, [encShape[1], encShape[2]], align_corners=True) + tf.layers.conv2d(endPoint, numFilters, (1, 1), strides=(1, 1), padding='same')
-
-		out = tf.layers.conv2d(activation(out), numFilters, filterSize, strides=(1, 1), padding=padding)
-
-		out = tf.layers.conv2d_transpose(activation(out), numFilters, filterSize, strides=strides, padding='valid')
-		if options.useSkipConnections:
-			endPointName = 'MaxPool_5a_3x3'
-			endPoint = endPoints[endPointName]
-			encShape = tf.shape(endPoint)
-			out = tf.image.resize_bilinear(out, [encShape[1], encShape[2]], align_corners=True) + tf.layers.conv2d(endPoint, numFilters, (1, 1), strides=(1, 1), padding='same')
-
-		out = tf.layers.conv2d(activation(out), numFilters, filterSize, strides=(1, 1), padding=padding)
-
-		out = tf.layers.conv2d_transpose(activation(out), numFilters, filterSize, strides=strides, padding='valid')
-		if options.useSkipConnections:
-			endPointName = 'Conv2d_4a_3x3'
-			endPoint = endPoints[endPointName]
-			encShape = tf.shape(endPoint)
-			out = tf.image.resize_bilinear(out, [encShape[1], encShape[2]], align_corners=True) + tf.layers.conv2d(endPoint, numFilters, (1, 1), strides=(1, 1), padding='same')
-
-		out = tf.layers.conv2d(activation(out), numFilters, filterSize, strides=(1, 1), padding=padding)
-
-		out = tf.layers.conv2d_transpose(activation(out), numFilters, filterSize, strides=strides, padding='valid')
-		if options.useSkipConnections:
-			# out = out + tf.layers.conv2d(endPoints['Conv2d_2b_3x3'], numFilters, (1, 1), strides=(1, 1), padding='same')
-			endPointName = 'Conv2d_2b_3x3'
-			endPoint = endPoints[endPointName]
-			encShape = tf.shape(endPoint)
-			out = tf.image.resize_bilinear(out, [encShape[1], encShape[2]], align_corners=True) + tf.layers.conv2d(endPoint, numFilters, (1, 1), strides=(1, 1), padding='same')
-
-		out = tf.layers.conv2d(activation(out), numFilters, filterSize, strides=(1, 1), padding=padding)
-
-		# Match dimensions (convolutions with 'valid' padding reducing the dimensions)
-		out = tf.image.resize_bilinear(out, [inputShape[1], inputShape[2]], align_corners=True) # TODO: Is it useful or it doesn't matter?
-		out = tf.layers.conv2d(activation(out), numFilters, filterSize, strides=(1, 1), padding='same')
+def attachDecoder(net, endPoints, inputShape, activation=tf.nn.relu, filterSize=(3, 3), strides=(2, 2), padding='same', reuse=None):
+	conv2d = tf.layers.separable_conv2d if options.decoderSeparableConvs else tf.layers.conv2d
+	with tf.name_scope('Decoder'), tf.variable_scope('Decoder', reuse=reuse, custom_getter=variableCustomGetter):
+		out = net
+		for numFilters, endPointName in zip(decoderFilters, decoderSkipEndPoints):
+			out = tf.layers.conv2d_transpose(activation(out), numFilters, filterSize, strides=strides, padding='valid')
+			if endPointName:
+				endPoint = endPoints[endPointName]
+				encShape = tf.shape(endPoint)
+				out = tf.cast(tf.image.resize_bilinear(out, [encShape[1], encShape[2]], align_corners=True), out.dtype) + tf.layers.conv2d(endPoint, numFilters, (1, 1), strides=(1, 1), padding='same')
+
+			out = conv2d(activation(out), numFilters, filterSize, strides=(1, 1), padding=padding)
+			tf.add_to_collection(DECODER_STAGE_OUTPUTS, out)
+
+		# Match dimensions (convolutions with 'valid' padding reducing the dimensions) at the output stride
+		outputShape = [inputShape[1], inputShape[2]]
+		if options.decoderOutputStride > 1:
+			outputShape = [(dim + options.decoderOutputStride - 1) // options.decoderOutputStride for dim in outputShape]
+		out = tf.cast(tf.image.resize_bilinear(out, outputShape, align_corners=True), out.dtype) # TODO: Is it useful or it doesn't matter? (resize always returns float32)
+		out = conv2d(activation(out), decoderFilters[-1], filterSize, strides=(1, 1), padding='same')
+		tf.add_to_collection(DECODER_STAGE_OUTPUTS, out)
 
 		out = tf.layers.conv2d(activation(out), options.numClasses, filterSize, strides=(1, 1), padding=padding) # Obtain per pixel predictions
-	return out
 
-# Create dataset objects
-trainDataset = loadDataset(options.trainFileName, dataAugmentation=True)
-trainIterator = trainDataset.make_initializable_iterator()
+		if options.decoderOutputStride > 1:
+			# Upsample the logits to the input size
+			out = tf.cast(tf.image.resize_bilinear(out, [inputShape[1], inputShape[2]], align_corners=True), out.dtype)
+	return out
 
-valDataset = loadDataset(options.valFileName)
+# Scaling only for NASNet and IncResV2
+def scaleInputImages(images):
+	scaledImages = tf.scalar_mul((1.0 / 255.0), images)
+	scaledImages = tf.subtract(scaledImages, 0.5)
+	scaledImages = tf.multiply(scaledImages, 2.0)
+	return scaledImages
+
+# The variables are shared between the replicas (reuse=True)
+def createIncResV2Encoder(scaledImages, reuse=None):
+	arg_scope = inception_resnet_v2.inception_resnet_v2_arg_scope()
+	with slim.arg_scope(arg_scope):
+		# logits, endPoints = inception_resnet_v2.inception_resnet_v2(scaledImages, is_training=False)
+		with tf.variable_scope('InceptionResnetV2', 'InceptionResnetV2', [scaledImages], reuse=reuse, custom_getter=variableCustomGetter) as scope:
+			with slim.arg_scope([slim.batch_norm, slim.dropout], is_training=False):
+			  net, endPoints = inception_resnet_v2.inception_resnet_v2_base(tf.cast(scaledImages, computeDtype), scope=scope, activation_fn=tf.nn.relu)
+	return net, endPoints
+
+# Ops created within the scope are compiled with XLA (along with their gradients)
+def xlaScope():
+	if options.useXLA:
+		return tf.contrib.compiler.jit.experimental_jit_scope()
+	return contextlib.ExitStack() # No-op
+
+# Floating point operations of an op (shapes have to be fully defined)
+def getOpFlops(graph, op):
+	if op.type == "Conv2DBackpropInput": # Transposed convolution (no statistics registered)
+		filterShape = op.inputs[1].get_shape().as_list()
+		inputShape = op.inputs[2].get_shape().as_list()
+		return 2 * int(np.prod(inputShape[:3])) * int(np.prod(filterShape))
+	try:
+		return tfOps.get_stats_for_node_def(graph, op.node_def, 'flops').value or 0
+	except ValueError:
+		return 0
+
+# FLOPs (per decoder layer) and latency of the decoder for a single image of the given size
+def reportDecoderCost(imageSize, numIterations=10):
+	print ("Decoder | Filters: %s | Skips: %s | Separable convolutions: %s | Output stride: %d" % (str(decoderFilters), str(decoderSkipEndPoints), str(options.decoderSeparableConvs), options.decoderOutputStride))
+	with tf.Graph().as_default() as graph:
+		images = tf.zeros([1, imageSize, imageSize, options.imageChannels], dtype=tf.float32)
+		encoderNet, encoderEndPoints = createIncResV2Encoder(images)
+		decoderLogits = attachDecoder(encoderNet, encoderEndPoints, [1, imageSize, imageSize, options.imageChannels]) # Static shapes are required for the FLOPs
+
+		layerFlops = collections.OrderedDict()
+		encoderFlops = 0
+		for op in graph.get_operations():
+			match = re.match(r'^(?:Decoder(?:_\d+)?/)+([^/]+)/', op.name) # Name scope and variable scope of the decoder
+			if match:
+				layerFlops[match.group(1)] = layerFlops.get(match.group(1), 0) + getOpFlops(graph, op)
+			elif op.name.startswith('InceptionResnetV2/'):
+				encoderFlops += getOpFlops(graph, op)
+
+		decoderFlops = sum(layerFlops.values())
+		for layerName, flops in layerFlops.items():
+			if flops > 0:
+				print ("Decoder layer: %s | GFLOPs: %.3f (%.1f%%)" % (layerName, flops / 1e9, 100.0 * flops / max(decoderFlops, 1)))
+
+		# Decoder latency with the encoder outputs fed (the encoder is not executed)
+		with tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))) as sess:
+			sess.run(tf.global_variables_initializer())
+			encoderOutputs = [encoderNet] + [encoderEndPoints[endPointName] for endPointName in decoderSkipEndPoints if endPointName]
+			feedDict = dict(zip(encoderOutputs, sess.run(encoderOutputs)))
+			sess.run(decoderLogits, feed_dict=feedDict) # Warmup
+			startTime = time.time()
+			for _ in range(numIterations):
+				sess.run(decoderLogits, feed_dict=feedDict)
+			decoderLatency = (time.time() - startTime) / numIterations
+
+	print ("Image size: %d | Encoder GFLOPs: %.3f | Decoder GFLOPs: %.3f | Decoder latency: %.2f ms" % (imageSize, encoderFlops / 1e9, decoderFlops / 1e9, decoderLatency * 1e3))
+
+# Compile the datasets into record files
+if options.compileDataset:
+	for dataFile in sorted(set([options.trainFileName, options.valFileName, options.testFileName])):
+		compileDataset(dataFile)
+
+	if not (options.trainModel or options.testModel):
+		print ("Dataset compilation completed!")
+		exit (0)
+
+if options.reportDecoderCost:
+	reportDecoderCost(options.maxImageSize)
+
+	if not (options.trainModel or options.testModel):
+		exit (0)
+
+# Training pipeline state which is fed when initializing the train iterator (used for resuming training mid-epoch)
+shuffleSeedPlaceholder = tf.placeholder_with_default(tf.constant(options.randomSeed, dtype=tf.int64), shape=(), name='ShuffleSeedPlaceholder')
+excludedFileNamesPlaceholder = tf.placeholder_with_default(tf.constant([], dtype=tf.string), shape=[None], name='ExcludedFileNamesPlaceholder')
+# Entries of previous epochs don't have to be removed since they are stored along with the shuffle seed of their epoch
+with tf.device('/cpu:0'):
+	excludedFileNamesTable = tf.contrib.lookup.MutableHashTable(key_dtype=tf.string, value_dtype=tf.int64, default_value=-1, name='ExcludedFileNamesTable')
+	insertExcludedFileNames = excludedFileNamesTable.insert(excludedFileNamesPlaceholder, tf.fill(tf.shape(excludedFileNamesPlaceholder), shuffleSeedPlaceholder))
+
+# Devices for the model replicas (the first replica is placed on the default device)
+replicaDevices = ["/%s:%d" % (options.replicaDeviceType, replicaIndex) for replicaIndex in range(options.numReplicas)]
+
+# Create dataset objects (one training shard per replica)
+trainIterators = []
+for replicaIndex in range(options.numReplicas):
+	trainDataset = loadDataset(options.trainFileName, dataAugmentation=not options.cacheEncoderFeatures, randomCrop=(options.trainCropSize > 0), batchSize=options.batchSize, 
+								shuffleSeed=shuffleSeedPlaceholder, excludedFileNamesTable=excludedFileNamesTable, numShards=options.numReplicas, shardIndex=replicaIndex, 
+								prefetchDevice=(replicaDevices[replicaIndex] if (options.numReplicas > 1) and (options.prefetchToDevice != "") else None))
+	trainIterators.append(trainDataset.make_initializable_iterator())
+trainIterator = trainIterators[0]
+
+# Validation and test are performed on complete images one at a time (the output images are written per image without the batch padding)
+valDataset = loadDataset(options.valFileName, batchSize=1)
 valIterator = valDataset.make_initializable_iterator()
 
-testDataset = loadDataset(options.testFileName)
+# Lightweight evaluation for model selection (no images are written, batched with aspect ratio bucketing)
+evalBatchSize = options.batchSize if options.aspectRatioBuckets > 0 else 1
+if options.evaluateSubsetSize > 0:
+	evaluateDataset = loadDataset(options.valFileName, batchSize=evalBatchSize, numSamples=options.evaluateSubsetSize)
+	evaluateIterator = evaluateDataset.make_initializable_iterator()
+else:
+	evaluateIterator = valIterator
+
+testDataset = loadDataset(options.testFileName, batchSize=1, resizeImages=not options.tiledInference) # Tiled inference is performed at the original resolution
 testIterator = testDataset.make_initializable_iterator()
 
 # globalStep = tf.train.get_or_create_global_step() # To be used with Optimizer
 
-# Data placeholders
-datasetSelectionPlaceholder = tf.placeholder(dtype=tf.int32, shape=(), name='DatasetSelectionPlaceholder')
-inputBatchImageNames, inputBatchImages, inputBatchMasks = tf.cond(tf.equal(datasetSelectionPlaceholder, TRAIN), lambda: trainIterator.get_next(), 
-															lambda: tf.cond(tf.equal(datasetSelectionPlaceholder, VAL), lambda: valIterator.get_next(), lambda: testIterator.get_next()))
+# Feedable iterator which defaults to the train iterator (train steps don't require any feed)
+trainIteratorHandle = trainIterator.string_handle()
+valIteratorHandle = valIterator.string_handle()
+evaluateIteratorHandle = evaluateIterator.string_handle()
+testIteratorHandle = testIterator.string_handle()
+
+datasetHandlePlaceholder = tf.placeholder_with_default(trainIteratorHandle, shape=(), name='DatasetHandlePlaceholder')
+inputIterator = tf.data.Iterator.from_string_handle(datasetHandlePlaceholder, valDataset.output_types, valDataset.output_shapes) # Shapes of the complete images (train might be cropped)
+inputBatchImageNames, inputBatchImages, inputBatchMasks = inputIterator.get_next()
+inputBatchImages = tf.identity(inputBatchImages, name="inputBatchImages") # Named entry point for feeding images directly (e.g. frozen graph)
 print ("Data shape: %s | Mask shape: %s" % (str(inputBatchImages.get_shape()), str(inputBatchMasks.get_shape())))
 
+# Time stamp recorded as soon as the batch has been delivered by the input pipeline
+def getTimeStamp():
+	return np.float64(time.time())
+
+with tf.control_dependencies([inputBatchImageNames, inputBatchImages, inputBatchMasks]):
+	inputTimeStamp = tf.py_func(getTimeStamp, [], tf.float64, stateful=True, name="InputTimeStamp")
+inputBatchShape = tf.shape(inputBatchMasks) # Used for computing the throughput in pixels (masks are also available when training from the feature cache)
+
 # if options.trainModel:
-with tf.name_scope('Model'):
+with tf.name_scope('Model'), xlaScope():
 	# Data placeholders
 	# inputBatchImagesPlaceholder = tf.placeholder(dtype=tf.float32, shape=[None, None, None, options.imageChannels], name="inputBatchImages")
 
-	# Scaling only for NASNet and IncResV2
-	scaledInputBatchImages = tf.scalar_mul((1.0 / 255.0), inputBatchImages)
-	scaledInputBatchImages = tf.subtract(scaledInputBatchImages, 0.5)
-	scaledInputBatchImages = tf.multiply(scaledInputBatchImages, 2.0)
+	scaledInputBatchImages = scaleInputImages(inputBatchImages)
 
 	# Create model
 	if options.modelName == "NASNet":
@@ -354,12 +1092,7 @@ with tf.name_scope('Model'):
 			logits, endPoints = nasnet.build_nasnet_large(scaledInputBatchImages, is_training=False, num_classes=options.numClasses)
 
 	elif options.modelName == "IncResV2":
-		arg_scope = inception_resnet_v2.inception_resnet_v2_arg_scope()
-		with slim.arg_scope(arg_scope):
-			# logits, endPoints = inception_resnet_v2.inception_resnet_v2(scaledInputBatchImages, is_training=False)
-			with tf.variable_scope('InceptionResnetV2', 'InceptionResnetV2', [scaledInputBatchImages], reuse=None) as scope:
-				with slim.arg_scope([slim.batch_norm, slim.dropout], is_training=False):
-				  net, endPoints = inception_resnet_v2.inception_resnet_v2_base(scaledInputBatchImages, scope=scope, activation_fn=tf.nn.relu)
+		net, endPoints = createIncResV2Encoder(scaledInputBatchImages)
 
 		variablesToRestore = slim.get_variables_to_restore(include=["InceptionResnetV2"])
 
@@ -371,36 +1104,176 @@ with tf.name_scope('Model'):
 print (endPoints.keys())
 if options.useSkipConnections:
 	print ("Adding skip connections from the encoder to the decoder!")
-predictedLogits = attachDecoder(net, endPoints, tf.shape(scaledInputBatchImages))
+
+# Encoder outputs used by the decoder (fed from the feature cache, in which case the encoder isn't executed)
+encoderFeatures = collections.OrderedDict([('net', net)])
+if options.useSkipConnections:
+	for endPointName in decoderSkipEndPoints:
+		if endPointName:
+			encoderFeatures[endPointName] = endPoints[endPointName]
+decoderOutputShape = tf.shape(scaledInputBatchImages)
+if options.cacheEncoderFeatures:
+	for featureName in encoderFeatures:
+		encoderFeatures[featureName] = tf.placeholder_with_default(encoderFeatures[featureName], shape=encoderFeatures[featureName].get_shape(), name="EncoderFeature_" + featureName)
+	decoderOutputShape = tf.placeholder_with_default(decoderOutputShape, shape=[4], name="DecoderOutputShape")
+	net = encoderFeatures['net']
+	endPoints = dict(endPoints, **{featureName: feature for featureName, feature in encoderFeatures.items() if featureName != 'net'})
+
+with xlaScope():
+	predictedLogits = attachDecoder(net, endPoints, decoderOutputShape)
+predictedLogits = tf.cast(predictedLogits, tf.float32) # Loss is always computed in float32
 predictedMask = tf.expand_dims(tf.argmax(predictedLogits, axis=-1), -1, name="predictedMasks")
 
+# Mark the ops within the blocks for recomputation during backprop (only the outputs of every recomputeBlockGroupSize-th block are kept in memory)
+# The recomputation is performed by the memory optimizer of the graph rewriter (manual mode)
+def markActivationsForRecomputation(groupSize):
+	operations = tf.get_default_graph().get_operations() # Creation order
+	isRecomputable = lambda op: (not op.op_def.is_stateful) and (op.type not in ["Const", "Identity", "VariableV2"]) and any(output.dtype.is_floating for output in op.outputs)
+
+	# Blocks of every replica: repeated residual units of the encoder (block35, block17 and block8) and decoder stages (ops created up to the stage output)
+	encoderBlocks = collections.OrderedDict()
+	decoderStages = collections.OrderedDict()
+	stageOutputOps = set([tensor.op for tensor in tf.get_collection(DECODER_STAGE_OUTPUTS)])
+	for op in operations:
+		replicaPrefix = re.match(r'^(Replica_\d+/)?', op.name).group(0)
+		match = re.match(r'^((Replica_\d+/)?Model/InceptionResnetV2/InceptionResnetV2/Repeat(_\d+)?/block\d+_\d+)/', op.name) # The encoder base re-enters the InceptionResnetV2 scope (nested name scope)
+		if match:
+			encoderBlocks.setdefault(replicaPrefix, collections.OrderedDict()).setdefault(match.group(1), []).append(op)
+		elif op.name.startswith(replicaPrefix + 'Decoder/'):
+			stages = decoderStages.setdefault(replicaPrefix, [[]])
+			stages[-1].append(op)
+			if op in stageOutputOps:
+				stages.append([])
+	blockSequences = [list(blocks.values()) for blocks in encoderBlocks.values()] + [[stage for stage in stages if len(stage) > 0] for stages in decoderStages.values()]
+
+	recomputedTensors = []
+	for blockSequence in blockSequences:
+		for groupStart in range(0, len(blockSequence), groupSize):
+			groupOps = [op for block in blockSequence[groupStart:groupStart + groupSize] for op in block]
+			for op in groupOps[:-1]: # The output of the group is stored
+				if isRecomputable(op):
+					op._set_attr("_recompute_hint", attr_value_pb2.AttrValue(i=1))
+					recomputedTensors += [output for output in op.outputs if output.dtype.is_floating]
+
+	print ("Marked %d ops in %d encoder blocks and %d decoder stages for recomputation" % (len(recomputedTensors), sum([len(blocks) for blocks in encoderBlocks.values()]), 
+			sum([len(blockSequence) for blockSequence in blockSequences[len(encoderBlocks):]])))
+	if (options.modelName == "IncResV2") and (len(encoderBlocks) == 0):
+		print ("Warning: No encoder blocks found for recomputation!")
+	return recomputedTensors
+
 if options.tensorboardVisualization:
-	tf.summary.image('Original Image', inputBatchImages, max_outputs=3)
-	tf.summary.image('Desired Mask', tf.to_float(inputBatchMasks), max_outputs=3)
-	tf.summary.image('Predicted Mask', tf.to_float(predictedMask), max_outputs=3)
+	tf.summary.image('Original Image', inputBatchImages, max_outputs=3, collections=["imageSummaries"])
+	tf.summary.image('Desired Mask', tf.to_float(inputBatchMasks), max_outputs=3, collections=["imageSummaries"])
+	tf.summary.image('Predicted Mask', tf.to_float(predictedMask), max_outputs=3, collections=["imageSummaries"])
 
-with tf.name_scope('Loss'):
+def createCrossEntropyLoss(predictedLogits, inputBatchMasks):
 	# Reshape 4D tensors to 2D, each row represents a pixel, each column a class
 	predictedMaskFlattened = tf.reshape(predictedLogits, (-1, tf.shape(predictedLogits)[1] * tf.shape(predictedLogits)[2], options.numClasses), name="fcnLogits")
 	inputMaskFlattened = tf.reshape(inputBatchMasks, (-1, tf.shape(inputBatchMasks)[1] * tf.shape(inputBatchMasks)[2]))
 	# inputMaskFlattened = tf.layers.flatten(inputBatchMasks)
 
 	# Define loss
-	weights = tf.cast(inputMaskFlattened != options.ignoreLabel, dtype=tf.float32)
-	weights = tf.cond(pred=tf.equal(weights, 2), true_fn=lambda: options.boundaryWeight, false_fn=lambda: weights)
-	crossEntropyLoss = tf.losses.sparse_softmax_cross_entropy(labels=inputMaskFlattened, logits=predictedMaskFlattened, weights=weights)
+	weights = tf.cast(tf.not_equal(inputMaskFlattened, options.ignoreLabel), dtype=tf.float32) # Per-pixel weights (padded pixels are ignored)
+	weights = tf.where(tf.equal(inputMaskFlattened, 2), options.boundaryWeight * weights, weights) # Boundary pixels (label 2) are weighted by the boundary weight
+	inputMaskFlattened = tf.where(tf.equal(inputMaskFlattened, options.ignoreLabel), tf.zeros_like(inputMaskFlattened), inputMaskFlattened) # Keep ignored (padded) labels in range
+	return tf.losses.sparse_softmax_cross_entropy(labels=inputMaskFlattened, logits=predictedMaskFlattened, weights=weights)
+
+with tf.name_scope('Loss'):
+	crossEntropyLoss = createCrossEntropyLoss(predictedLogits, inputBatchMasks)
 	regLoss = options.weightDecayLambda * tf.reduce_sum(tf.losses.get_regularization_losses())
 	loss = tf.add(crossEntropyLoss, regLoss, name="totalLoss")
 
+# Additional replicas for synchronous data-parallel training (the first replica is the model defined above which is also used for validation and testing)
+# Every replica reads its own shard and shares the variables of the first replica
+replicaLosses = [loss]
+replicaImageNames = []
+for replicaIndex in range(1, options.numReplicas):
+	replicaBatchImageNames, replicaBatchImages, replicaBatchMasks = trainIterators[replicaIndex].get_next()
+	replicaImageNames.append(replicaBatchImageNames)
+	with tf.device(replicaDevices[replicaIndex]), tf.name_scope('Replica_%d' % (replicaIndex)):
+		with tf.name_scope('Model'), xlaScope():
+			replicaNet, replicaEndPoints = createIncResV2Encoder(scaleInputImages(replicaBatchImages), reuse=True)
+		with xlaScope():
+			replicaLogits = attachDecoder(replicaNet, replicaEndPoints, tf.shape(replicaBatchImages), reuse=True)
+		with tf.name_scope('Loss'):
+			replicaLosses.append(createCrossEntropyLoss(tf.cast(replicaLogits, tf.float32), replicaBatchMasks) + regLoss)
+
+if options.recomputeActivations:
+	recomputedTensors = markActivationsForRecomputation(options.recomputeBlockGroupSize)
+	# Size of the activations which are recomputed instead of being kept for backprop and the peak memory usage (maximum over the replica devices)
+	recomputedActivationBytes = tf.add_n([tf.cast(tf.size(tensor), tf.int64) * tensor.dtype.size for tensor in recomputedTensors])
+	devicePeakMemoryInUse = []
+	for replicaDevice in (replicaDevices if options.numReplicas > 1 else [None]): # MaxBytesInUse only reports the device it is placed on
+		with tf.device(replicaDevice):
+			devicePeakMemoryInUse.append(tf.contrib.memory_stats.MaxBytesInUse())
+	peakMemoryInUse = tf.reduce_max(tf.stack(devicePeakMemoryInUse))
+
+with tf.name_scope('Metrics'):
+	# Streaming confusion matrix (rows: ground-truth, columns: prediction) accumulated over the complete pass on the device
+	# Ignored pixels are assigned to an additional bin which is discarded
+	with tf.device('/cpu:0'):
+		confusionMatrix = tf.get_variable("confusionMatrix", shape=[options.numClasses, options.numClasses], dtype=tf.int64, initializer=tf.zeros_initializer(), 
+											trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+	flattenedLabels = tf.reshape(inputBatchMasks, [-1])
+	flattenedPredictions = tf.reshape(tf.cast(predictedMask, tf.int32), [-1])
+	confusionIndices = tf.where(tf.equal(flattenedLabels, options.ignoreLabel), tf.fill(tf.shape(flattenedLabels), options.numClasses * options.numClasses), 
+								flattenedLabels * options.numClasses + flattenedPredictions)
+	batchConfusionMatrix = tf.bincount(confusionIndices, minlength=options.numClasses * options.numClasses + 1, maxlength=options.numClasses * options.numClasses + 1)
+	batchConfusionMatrix = tf.reshape(batchConfusionMatrix[:options.numClasses * options.numClasses], [options.numClasses, options.numClasses])
+	with tf.device('/cpu:0'):
+		updateConfusionMatrix = tf.assign_add(confusionMatrix, tf.cast(batchConfusionMatrix, tf.int64)).op
+		resetConfusionMatrix = tf.variables_initializer([confusionMatrix])
+
 with tf.name_scope('Optimizer'):
 	# Define Optimizer
 	optimizer = tf.train.AdamOptimizer(learning_rate=options.learningRate)
 
-	# Op to calculate every variable gradient
-	gradients = tf.gradients(loss, tf.trainable_variables())
-	gradients = list(zip(gradients, tf.trainable_variables()))
-	# Op to update all variables according to their gradient
-	applyGradients = optimizer.apply_gradients(grads_and_vars=gradients)
+	# Only the decoder is trained with a frozen encoder
+	if options.freezeEncoder:
+		trainableVariables = [var for var in tf.trainable_variables() if var.op.name.startswith('Decoder/')]
+	else:
+		trainableVariables = tf.trainable_variables()
+
+	if computeDtype == tf.float16:
+		# Dynamic loss scaling to avoid underflow of the float16 gradients (steps with overflow are skipped)
+		lossScaleManager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(init_loss_scale=options.initialLossScale, incr_every_n_steps=options.lossScaleIncrementSteps)
+		optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, lossScaleManager)
+
+	# Op to calculate every variable gradient (computed on the device of the respective replica)
+	replicaGradients = []
+	# The gradients of the additional replicas are created within the replica name scope so that every replica uses the gradients/ scope (recomputation target)
+	for replicaIndex, replicaLoss in enumerate(replicaLosses):
+		with (tf.name_scope('Replica_%d' % (replicaIndex)) if replicaIndex > 0 else contextlib.ExitStack()):
+			if computeDtype == tf.float16:
+				replicaGradients.append(optimizer.compute_gradients(replicaLoss, var_list=trainableVariables, colocate_gradients_with_ops=(options.numReplicas > 1)))
+			else:
+				replicaGradients.append(list(zip(tf.gradients(replicaLoss, trainableVariables, colocate_gradients_with_ops=(options.numReplicas > 1)), trainableVariables)))
+
+	# Average the gradients of all the replicas (synchronous data-parallel training)
+	if options.numReplicas > 1:
+		gradients = []
+		for gradientsAndVars in zip(*replicaGradients):
+			var = gradientsAndVars[0][1]
+			replicaVarGradients = [tf.convert_to_tensor(grad) for grad, _ in gradientsAndVars if grad is not None]
+			gradients.append((tf.add_n(replicaVarGradients) / float(len(replicaVarGradients)) if len(replicaVarGradients) > 0 else None, var))
+	else:
+		gradients = replicaGradients[0]
+
+	if options.gradientAccumulationSteps > 1:
+		# Accumulate the gradients over several micro-steps (local variables since they are not part of the model)
+		gradients = [(grad, var) for grad, var in gradients if grad is not None]
+		gradientAccumulators = [tf.Variable(tf.zeros(var.get_shape(), dtype=tf.float32), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="GradientAccumulator") for grad, var in gradients]
+		accumulateGradients = tf.group(*[tf.assign_add(accumulator, tf.convert_to_tensor(grad)) for accumulator, (grad, var) in zip(gradientAccumulators, gradients)])
+
+		# Op to update all variables according to their average gradient (executed after accumulating the gradients of the last micro-step)
+		with tf.control_dependencies([accumulateGradients]):
+			averageGradients = [(accumulator / float(options.gradientAccumulationSteps), var) for accumulator, (grad, var) in zip(gradientAccumulators, gradients)]
+			applyAccumulatedGradients = optimizer.apply_gradients(grads_and_vars=averageGradients)
+		with tf.control_dependencies([applyAccumulatedGradients]):
+			applyGradients = tf.group(*[tf.assign(accumulator, tf.zeros_like(accumulator)) for accumulator in gradientAccumulators])
+	else:
+		# Op to update all variables according to their gradient
+		applyGradients = optimizer.apply_gradients(grads_and_vars=gradients)
 
 # Initializing the variables
 init = tf.global_variables_initializer()
@@ -408,27 +1281,262 @@ init_local = tf.local_variables_initializer()
 
 if options.tensorboardVisualization:
 	# Create a summary to monitor cost tensor
-	tf.summary.scalar("reg_loss", regLoss)
-	tf.summary.scalar("cross_entropy", crossEntropyLoss)
-	tf.summary.scalar("total_loss", loss)
+	tf.summary.scalar("reg_loss", regLoss, collections=["scalarSummaries"])
+	tf.summary.scalar("cross_entropy", crossEntropyLoss, collections=["scalarSummaries"])
+	tf.summary.scalar("total_loss", loss, collections=["scalarSummaries"])
+	tf.summary.scalar("effective_batch_size", tf.constant(options.batchSize * options.numReplicas * options.gradientAccumulationSteps), collections=["scalarSummaries"])
+	if computeDtype == tf.float16:
+		tf.summary.scalar("loss_scale", lossScaleManager.get_loss_scale(), collections=["scalarSummaries"])
 
 	# Create summaries to visualize weights
 	for var in tf.trainable_variables():
-		tf.summary.histogram(var.name, var)
+		tf.summary.histogram(var.name, var, collections=["histogramSummaries"])
 	# Summarize all gradients
 	for grad, var in gradients:
 		if grad is not None:
-			tf.summary.histogram(var.name + '/gradient', grad)
+			tf.summary.histogram(var.name + '/gradient', grad, collections=["histogramSummaries"])
 
-	# Merge all summaries into a single op
-	mergedSummaryOp = tf.summary.merge_all()
+	# Merge the summaries into separate ops since they are computed at different intervals
+	summaryOps = [(summaryKey, summaryOp, summaryStep) for summaryKey, summaryOp, summaryStep in [("scalarSummaries", tf.summary.merge_all(key="scalarSummaries"), options.scalarSummaryStep), 
+					("imageSummaries", tf.summary.merge_all(key="imageSummaries"), options.imageSummaryStep), ("histogramSummaries", tf.summary.merge_all(key="histogramSummaries"), options.histogramSummaryStep)] 
+					if (summaryOp is not None) and (summaryStep > 0)]
 
 # 'Saver' op to save and restore all the variables
 saver = tf.train.Saver()
 
+def getTrainingStateFileName(checkpointFileName):
+	return checkpointFileName + ".state.json"
+
+# Saves checkpoints in the background: the variables are copied to the host and written from a separate graph on the CPU
+class AsyncCheckpointSaver(object):
+	def __init__(self, variables, checkpointPrefix, maxToKeep, keepCheckpointEveryNHours, latestFileName="checkpoint"):
+		self.variables = variables
+		self.checkpointPrefix = checkpointPrefix
+		self.latestFileName = latestFileName
+		self.thread = None
+
+		self.graph = tf.Graph()
+		with self.graph.as_default(), tf.device('/cpu:0'):
+			self.placeholders = []
+			assignOps = []
+			for var in variables:
+				# Same names as in the training graph so that the checkpoints are interchangeable
+				snapshotVar = tf.get_variable(var.op.name, shape=var.get_shape(), dtype=var.dtype.base_dtype, initializer=tf.zeros_initializer(), trainable=False)
+				placeholder = tf.placeholder(dtype=var.dtype.base_dtype, shape=var.get_shape())
+				self.placeholders.append(placeholder)
+				assignOps.append(tf.assign(snapshotVar, placeholder))
+			self.assignOp = tf.group(*assignOps)
+			self.saver = tf.train.Saver(max_to_keep=maxToKeep, keep_checkpoint_every_n_hours=keepCheckpointEveryNHours)
+			# Checkpoints of previous runs (when resuming) are subject to the same retention policy
+			checkpointState = tf.train.get_checkpoint_state(os.path.dirname(checkpointPrefix), latest_filename=latestFileName)
+			if checkpointState is not None:
+				self.saver.recover_last_checkpoints(checkpointState.all_model_checkpoint_paths)
+			self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+			self.sess.run(tf.global_variables_initializer())
+
+	# The training state (epoch, step and consumed images) is written alongside the checkpoint
+	def save(self, sess, globalStep, trainingState=None):
+		values = sess.run(self.variables) # Snapshot (training only waits for the copy to the host)
+		self.wait() # Only one save in flight
+		self.thread = threading.Thread(target=self.write, args=(values, globalStep, trainingState))
+		self.thread.start()
+
+	def write(self, values, globalStep, trainingState):
+		self.sess.run(self.assignOp, feed_dict=dict(zip(self.placeholders, values)))
+		outputFileName = self.saver.save(self.sess, self.checkpointPrefix, global_step=globalStep, latest_filename=self.latestFileName, write_meta_graph=False)
+		if trainingState is not None:
+			with open(getTrainingStateFileName(outputFileName), 'w') as f:
+				json.dump(trainingState, f)
+		print ("Model saved: %s" % (outputFileName))
+
+	def wait(self):
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def close(self):
+		self.wait()
+		self.sess.close()
+
+# Encoder features (along with the masks) of complete training batches stored as compressed files
+# The files are written in the background and read back in random batch order by a prefetching thread
+class EncoderFeatureCache(object):
+	def __init__(self, cacheDir, queueSize, prefetchBatches):
+		self.cacheDir = cacheDir
+		self.prefetchBatches = max(prefetchBatches, 1)
+		self.indexFileName = os.path.join(cacheDir, "index.json")
+		if not os.path.exists(cacheDir):
+			os.makedirs(cacheDir)
+
+		# The cache is only used once it covers the complete training set
+		self.entries = None
+		if os.path.exists(self.indexFileName):
+			with open(self.indexFileName) as f:
+				self.entries = json.load(f)['entries']
+			print ("Encoder feature cache loaded: %d batches" % (len(self.entries)))
+
+		self.jobQueue = queue.Queue(maxsize=queueSize)
+		self.errors = []
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def isComplete(self):
+		return self.entries is not None
+
+	def run(self):
+		while True:
+			batch = self.jobQueue.get()
+			try:
+				if batch is None: # Shutdown
+					return
+				cacheFileName = os.path.join(self.cacheDir, hashlib.md5("\n".join(batch['fileNames']).encode("utf-8")).hexdigest() + ".npz")
+				with open(cacheFileName + ".tmp", 'wb') as f:
+					np.savez_compressed(f, **batch)
+				os.rename(cacheFileName + ".tmp", cacheFileName) # Incomplete files are never read
+			except Exception as e:
+				self.errors.append(e)
+			finally:
+				self.jobQueue.task_done()
+
+	def write(self, fileNames, features, masks, outputShape):
+		batch = dict(features, fileNames=np.array([fileName.decode("utf-8") for fileName in fileNames]), masks=masks, outputShape=outputShape)
+		self.jobQueue.put(batch) # Blocks if the queue is full
+
+	def flush(self):
+		self.jobQueue.join()
+		if len(self.errors) > 0:
+			errors, self.errors = self.errors, []
+			raise errors[0]
+
+	# Creates the index once all the images have been cached (epochs might have been interrupted)
+	def finalize(self, expectedFileNames):
+		self.flush()
+		entries = []
+		cachedFileNames = set()
+		for cacheFileName in sorted(os.listdir(self.cacheDir)):
+			if cacheFileName.endswith(".npz"):
+				with np.load(os.path.join(self.cacheDir, cacheFileName)) as data:
+					fileNames = [str(fileName) for fileName in data['fileNames']]
+				entries.append({'cacheFileName': cacheFileName, 'fileNames': fileNames})
+				cachedFileNames.update(fileNames)
+
+		numMissing = len(set(expectedFileNames) - cachedFileNames)
+		if numMissing > 0:
+			print ("Encoder feature cache incomplete: %d images missing" % (numMissing))
+			return
+
+		with open(self.indexFileName, 'w') as f:
+			json.dump({'entries': entries}, f)
+		self.entries = entries
+		print ("Encoder feature cache completed: %d batches" % (len(self.entries)))
+
+	# Batches in random order (depending only on the seed) skipping the batches which have already been consumed
+	def readBatches(self, randomSeed, excludedFileNames):
+		excludedFileNames = set(excludedFileNames)
+		entries = [entry for entry in self.entries if not all((fileName.encode("utf-8") in excludedFileNames) for fileName in entry['fileNames'] if len(fileName) > 0)]
+		order = np.random.RandomState(randomSeed).permutation(len(entries))
+
+		batchQueue = queue.Queue(maxsize=self.prefetchBatches)
+		def readBatchFiles():
+			for index in order:
+				with np.load(os.path.join(self.cacheDir, entries[index]['cacheFileName'])) as data:
+					batchQueue.put({key: data[key] for key in data.files})
+			batchQueue.put(None)
+
+		thread = threading.Thread(target=readBatchFiles)
+		thread.daemon = True
+		thread.start()
+		while True:
+			batch = batchQueue.get()
+			if batch is None:
+				return
+			yield batch
+
+	def close(self):
+		self.flush()
+		self.jobQueue.put(None)
+		self.thread.join()
+
+# Rolling statistics of the training step time split and throughput
+class StepProfiler(object):
+	COMPONENTS = ['inputWait', 'compute', 'summaries', 'imageSaving']
+
+	def __init__(self, windowSize):
+		self.steps = collections.deque(maxlen=windowSize)
+
+	def record(self, stepTime, numImages, numPixels, **componentTimes):
+		self.steps.append(dict(componentTimes, stepTime=stepTime, numImages=numImages, numPixels=numPixels))
+
+	def getStatistics(self):
+		totalTime = max(sum(step['stepTime'] for step in self.steps), 1e-9)
+		statistics = {'stepTime': totalTime / max(len(self.steps), 1)}
+		for component in StepProfiler.COMPONENTS:
+			statistics[component] = sum(step[component] for step in self.steps) / max(len(self.steps), 1)
+		statistics['imagesPerSec'] = sum(step['numImages'] for step in self.steps) / totalTime
+		statistics['pixelsPerSec'] = sum(step['numPixels'] for step in self.steps) / totalTime
+		return statistics
+
+	def toString(self, statistics):
+		return "Step time: %.4f sec (%s) | Throughput: %.2f images/sec, %.2f MPixels/sec" % (statistics['stepTime'], 
+				", ".join(["%s: %.4f sec" % (component, statistics[component]) for component in StepProfiler.COMPONENTS]), 
+				statistics['imagesPerSec'], statistics['pixelsPerSec'] / 1e6)
+
+# Keeps track of the best validation result (loss or mIoU) for model selection and early stopping
+class BestModelTracker(object):
+	def __init__(self, metricName, patience):
+		self.metricName = metricName
+		self.patience = patience
+		self.bestValue = None
+		self.numEvaluationsWithoutImprovement = 0
+
+	def update(self, averageLoss, metrics):
+		value = averageLoss if self.metricName == "loss" else metrics['meanIoU']
+		if (self.bestValue is None) or (value < self.bestValue if self.metricName == "loss" else value > self.bestValue):
+			self.bestValue = value
+			self.numEvaluationsWithoutImprovement = 0
+			return True
+
+		self.numEvaluationsWithoutImprovement += 1
+		return False
+
+	def shouldStop(self):
+		return (self.patience > 0) and (self.numEvaluationsWithoutImprovement >= self.patience)
+
+	def getState(self):
+		return {'bestValue': self.bestValue, 'numEvaluationsWithoutImprovement': self.numEvaluationsWithoutImprovement}
+
+	def setState(self, state):
+		self.bestValue = state['bestValue']
+		self.numEvaluationsWithoutImprovement = state['numEvaluationsWithoutImprovement']
+
+# Computes the loss and the metrics on the given dataset without fetching the images
+def evaluateModel(sess, iterator, datasetHandle):
+	sess.run([iterator.initializer, resetConfusionMatrix])
+	averageLoss = 0.0
+	iterations = 0
+	try:
+		while True:
+			[batchLoss, _] = sess.run([loss, updateConfusionMatrix], feed_dict={datasetHandlePlaceholder: datasetHandle})
+			averageLoss += batchLoss
+			iterations += 1
+
+	except tf.errors.OutOfRangeError:
+		pass
+
+	averageLoss /= max(iterations, 1)
+	return averageLoss, computeSegmentationMetrics(sess.run(confusionMatrix))
+
 # GPU config
 config = tf.ConfigProto()
 config.gpu_options.allow_growth=True
+if options.numReplicas > 1:
+	config.allow_soft_placement = True # Input pipelines and CPU-only kernels
+	if options.replicaDeviceType == "cpu":
+		config.device_count['CPU'] = options.numReplicas
+if options.recomputeActivations:
+	config.graph_options.rewrite_options.memory_optimization = rewriter_config_pb2.RewriterConfig.MANUAL
+	config.graph_options.rewrite_options.memory_optimizer_target_node_name_scope = "gradients/" # Optimizer/gradients/ and Optimizer/Replica_<n>/gradients/"
 
 # Train model
 if options.trainModel:
@@ -437,6 +1545,7 @@ if options.trainModel:
 		sess.run(init)
 		sess.run(init_local)
 
+		trainingState = None
 		if options.startTrainingFromScratch:
 			print ("Removing previous checkpoints and logs")
 			if os.path.exists(options.logsDir): 
@@ -461,28 +1570,163 @@ if options.trainModel:
 
 		# Restore checkpoint
 		else:
-			print ("Restoring from checkpoint")
-			saver = tf.train.import_meta_graph(os.path.join(options.outputModelDir, options.outputModelName + ".meta"))
-			saver.restore(sess, os.path.join(options.outputModelDir, options.outputModelName))
+			# Use the most recent checkpoint (either a step checkpoint or the final model which has its own checkpoint state file)
+			checkpointFileNames = [fileName for fileName in [tf.train.latest_checkpoint(options.outputModelDir), tf.train.latest_checkpoint(options.outputModelDir, latest_filename="checkpoint_final")] 
+									if fileName is not None]
+			if len(checkpointFileNames) > 0:
+				checkpointFileName = max(checkpointFileNames, key=lambda fileName: os.path.getmtime(fileName + ".index"))
+			else:
+				checkpointFileName = os.path.join(options.outputModelDir, options.outputModelName)
+			print ("Restoring from checkpoint: %s" % (checkpointFileName))
+			saver.restore(sess, checkpointFileName)
+
+			# Resume from the saved position within the epoch (only available for step checkpoints)
+			if os.path.exists(getTrainingStateFileName(checkpointFileName)):
+				with open(getTrainingStateFileName(checkpointFileName)) as f:
+					trainingState = json.load(f)
+				options.randomSeed = trainingState['randomSeed']
+				print ("Resuming training from epoch: %d | Iteration: %d | Global step: %d" % (trainingState['epoch'], trainingState['step'], trainingState['globalStep']))
+
+		checkpointSaver = AsyncCheckpointSaver(tf.global_variables(), os.path.join(options.outputModelDir, options.outputModelName), options.maxCheckpointsToKeep, options.keepCheckpointEveryNHours)
+
+		# The best model uses its own checkpoint state file so that it doesn't interfere with resuming from the latest checkpoint
+		bestModelSaver = AsyncCheckpointSaver(tf.global_variables(), os.path.join(options.outputModelDir, options.bestModelName), 1, 10000.0, latestFileName="checkpoint_best")
+		bestModelTracker = BestModelTracker(options.bestModelMetric, options.earlyStoppingPatience)
+		if (trainingState is not None) and ('bestModelTracker' in trainingState):
+			bestModelTracker.setState(trainingState['bestModelTracker'])
+
+		def updateBestModel(averageLoss, metrics):
+			if bestModelTracker.update(averageLoss, metrics):
+				print ("New best model | Validation loss: %f | Validation mIoU: %f" % (averageLoss, metrics['meanIoU']))
+				bestModelSaver.save(sess, globalStep)
+			else:
+				print ("No improvement for %d evaluation(s) | Best validation %s: %f" % (bestModelTracker.numEvaluationsWithoutImprovement, options.bestModelMetric, bestModelTracker.bestValue))
+
+		# Handles for switching the input iterator to the validation and test sets
+		valHandle, testHandle, evaluateHandle = sess.run([valIteratorHandle, testIteratorHandle, evaluateIteratorHandle])
 
 		if options.tensorboardVisualization:
 			# Op for writing logs to Tensorboard
-			summaryWriter = tf.summary.FileWriter(options.logsDir, graph=tf.get_default_graph())
+			# Summaries are buffered and written to disk by the writer's background thread
+			summaryWriter = tf.summary.FileWriter(options.logsDir, graph=tf.get_default_graph(), max_queue=options.summaryQueueSize, flush_secs=options.summaryFlushSecs)
 
 		print ("Starting network training")
 		globalStep = 0
+		startEpoch = 0
+		if trainingState is not None:
+			globalStep = trainingState['globalStep']
+			startEpoch = trainingState['epoch']
+
+		if options.cacheEncoderFeatures:
+			encoderFeatureCache = EncoderFeatureCache(options.encoderFeatureCacheDir, max(options.prefetchBatches, 1), options.prefetchBatches) # Batches of features can be large (especially with skip connections)
+			trainFileNames, _ = readDataFileNames(options.trainFileName)
+
+		if options.profileTraining:
+			stepProfiler = StepProfiler(options.profileWindowSize)
+		if (options.profileTraceStep > 0) and (not os.path.exists(options.profileTraceDir)):
+			os.makedirs(options.profileTraceDir)
 
 		# Keep training until reach max iterations
-		for epoch in range(options.trainingEpochs):
-			# Initialize the dataset iterators
-			sess.run(trainIterator.initializer)
+		stopTraining = False
+		for epoch in range(startEpoch, options.trainingEpochs):
+			step = 0
+			consumedFileNames = []
+			if (trainingState is not None) and (epoch == trainingState['epoch']):
+				step = trainingState['step']
+				consumedFileNames = [fileName.encode("utf-8") for fileName in trainingState['consumedFileNames']]
+
+			# Train the decoder from the encoder feature cache once it is complete (the input pipeline and the encoder are skipped)
+			useFeatureCache = options.cacheEncoderFeatures and encoderFeatureCache.isComplete()
+			if useFeatureCache:
+				cachedBatches = encoderFeatureCache.readBatches(options.randomSeed + epoch, consumedFileNames)
+			else:
+				# Initialize the dataset iterators (the shuffle order only depends on the seed and the epoch)
+				trainIteratorFeedDict = {shuffleSeedPlaceholder: options.randomSeed + epoch, excludedFileNamesPlaceholder: np.array(consumedFileNames, dtype=object)}
+				sess.run(insertExcludedFileNames, feed_dict=trainIteratorFeedDict)
+				sess.run([iterator.initializer for iterator in trainIterators], feed_dict=trainIteratorFeedDict)
 			
 			try:
-				step = 0
 				while True:
+					# All the required outputs are fetched along with the optimization op so that no batch is consumed without training on it
+					isDisplayStep = (step % options.displayStep == 0)
+					if (options.gradientAccumulationSteps > 1) and ((globalStep + 1) % options.gradientAccumulationSteps != 0):
+						fetches = {'accumulateGradients': accumulateGradients}
+					else:
+						fetches = {'applyGradients': applyGradients}
+					if options.tensorboardVisualization:
+						# Image summaries require the input images which aren't available when training from the feature cache
+						fetches['summaries'] = [summaryOp for summaryKey, summaryOp, summaryStep in summaryOps if (globalStep % summaryStep == 0) and not (useFeatureCache and summaryKey == "imageSummaries")]
+					if (options.logInputWaitTime or options.profileTraining) and not useFeatureCache:
+						fetches['inputTimeStamp'] = inputTimeStamp
+					if options.profileTraining:
+						fetches['inputShape'] = inputBatchShape
+					if options.recomputeActivations and isDisplayStep:
+						fetches['peakMemoryInUse'] = peakMemoryInUse
+						if not useFeatureCache: # Depends on the encoder activations
+							fetches['recomputedActivationBytes'] = recomputedActivationBytes
+					fetches['fileName'] = inputBatchImageNames # Required for keeping track of the consumed images
+					if options.numReplicas > 1:
+						fetches['replicaFileNames'] = replicaImageNames
+					if isDisplayStep:
+						if not useFeatureCache:
+							fetches['originalImage'] = inputBatchImages
+						fetches['loss'] = loss
+						fetches['predictedMask'] = predictedMask
+					if options.debug:
+						fetches['predictedMask'] = predictedMask
+						fetches['gtMask'] = inputBatchMasks
+						fetches['endPoints'] = encoderFeatures if useFeatureCache else endPoints
+					if options.cacheEncoderFeatures and not useFeatureCache:
+						fetches['encoderFeatures'] = encoderFeatures
+						fetches['gtMask'] = inputBatchMasks
+						fetches['decoderOutputShape'] = decoderOutputShape
+
+					stepStartTime = time.time()
+					feedDict = None
+					if useFeatureCache:
+						cachedBatch = next(cachedBatches, None)
+						if cachedBatch is None:
+							raise tf.errors.OutOfRangeError(None, None, "Encoder feature cache exhausted")
+						feedDict = {feature: cachedBatch[featureName] for featureName, feature in encoderFeatures.items()}
+						feedDict.update({inputBatchImageNames: np.array([fileName.encode("utf-8") for fileName in cachedBatch['fileNames']], dtype=object), inputBatchMasks: cachedBatch['masks'], decoderOutputShape: cachedBatch['outputShape']})
+						inputWaitTime = time.time() - stepStartTime
+
+					# Run optimization op (backprop)
+					isTraceStep = (options.profileTraceStep > 0) and (globalStep % options.profileTraceStep == 0)
+					if isTraceStep:
+						runMetadata = tf.RunMetadata()
+						results = sess.run(fetches, feed_dict=feedDict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=runMetadata)
+					else:
+						results = sess.run(fetches, feed_dict=feedDict)
+					sessRunEndTime = time.time()
+					if 'inputTimeStamp' in results:
+						inputWaitTime = max(results['inputTimeStamp'] - stepStartTime, 0.0)
+
+					if options.cacheEncoderFeatures and not useFeatureCache:
+						encoderFeatureCache.write(results['fileName'], results['encoderFeatures'], results['gtMask'], results['decoderOutputShape'])
+
+					if isTraceStep:
+						traceFileName = os.path.join(options.profileTraceDir, "timeline_step_%d.json" % (globalStep))
+						with open(traceFileName, 'w') as f:
+							f.write(timeline.Timeline(runMetadata.step_stats).generate_chrome_trace_format())
+						print ("Trace saved: %s" % (traceFileName))
+						if options.tensorboardVisualization:
+							summaryWriter.add_run_metadata(runMetadata, "step_%d" % (globalStep), global_step=globalStep)
+
+					if options.tensorboardVisualization:
+						for summary in results['summaries']:
+							summaryWriter.add_summary(summary, global_step=globalStep)
+					summaryEndTime = time.time()
+
+					if options.logInputWaitTime:
+						stepTime = time.time() - stepStartTime
+						print ("Epoch: %d | Iteration: %d | Step time: %.4f sec | Input wait time: %.4f sec (%.1f%%)" % (epoch, step, stepTime, inputWaitTime, 100.0 * inputWaitTime / stepTime))
+						if options.tensorboardVisualization:
+							summaryWriter.add_summary(tf.Summary(value=[tf.Summary.Value(tag="input_wait_time", simple_value=inputWaitTime)]), global_step=globalStep)
+
 					# Debug mode
 					if options.debug:
-						[predMask, gtMask] = sess.run([predictedMask, inputBatchMasks], feed_dict={datasetSelectionPlaceholder: TRAIN})
+						predMask, gtMask = results['predictedMask'], results['gtMask']
 						print ("Prediction shape: %s | GT shape: %s" % (str(predMask.shape), str(gtMask.shape)))
 						assert (predMask.shape == gtMask.shape), "Error: Prediction and ground-truth shapes don't match"
 						if np.isnan(np.sum(predMask)):
@@ -493,47 +1737,80 @@ if options.trainModel:
 						print ("Unique labels in GT:", np.unique(gtMask))
 
 						# Verify end point shapes
-						for endPointName in endPoints:
-							endPointOutput = sess.run(endPoints[endPointName], feed_dict={datasetSelectionPlaceholder: TRAIN})
-							print ("End point: %s | Shape: %s" % (endPointName, str(endPointOutput.shape)))
+						for endPointName in results['endPoints']: # Only the cached end points are fetched when training from the feature cache
+							print ("End point: %s | Shape: %s" % (endPointName, str(results['endPoints'][endPointName].shape)))
 
-					# Run optimization op (backprop)
-					if options.tensorboardVisualization:
-						_, summary = sess.run([applyGradients, mergedSummaryOp], feed_dict={datasetSelectionPlaceholder: TRAIN})
-						summaryWriter.add_summary(summary, global_step=globalStep) # Write logs at every iteration
-					else:
-						_ = sess.run(applyGradients, feed_dict={datasetSelectionPlaceholder: TRAIN})
-					
-					if step % options.displayStep == 0:
-						# Calculate batch loss
-						[fileName, originalImage, trainLoss, predictedSegMask] = sess.run([inputBatchImageNames, inputBatchImages, loss, predictedMask], feed_dict={datasetSelectionPlaceholder: TRAIN})
-						print ("Epoch: %d | Iteration: %d | Minibatch Loss: %f" % (epoch, step, trainLoss))
+					if isDisplayStep:
+						# Batch loss (computed in the forward pass of the optimization step)
+						print ("Epoch: %d | Iteration: %d | Minibatch Loss: %f" % (epoch, step, results['loss']))
 
-						# Save image results
-						writeMaskToImage(originalImage, predictedSegMask, options.trainImagesOutputDirectory, fileName)
+						if options.recomputeActivations:
+							print ("Epoch: %d | Iteration: %d | Peak memory: %.2f MB | Recomputed activations (not stored): %.2f MB" % (epoch, step, results['peakMemoryInUse'] / 2.0**20, results.get('recomputedActivationBytes', 0) / 2.0**20))
+							if options.tensorboardVisualization:
+								summaryWriter.add_summary(tf.Summary(value=[tf.Summary.Value(tag="memory/peak_memory_mb", simple_value=results['peakMemoryInUse'] / 2.0**20), 
+															tf.Summary.Value(tag="memory/recomputed_activations_mb", simple_value=results.get('recomputedActivationBytes', 0) / 2.0**20)]), global_step=globalStep)
 
+						# Save image results
+						imageSavingStartTime = time.time()
+						if not useFeatureCache:
+							maskWriter.write(results['originalImage'], results['predictedMask'], options.trainImagesOutputDirectory, results['fileName'])
+						imageSavingTime = time.time() - imageSavingStartTime
+
+					batchFileNames = [fileName for replicaFileNames in [results['fileName']] + results.get('replicaFileNames', []) for fileName in replicaFileNames if len(fileName) > 0] # Skip the padding
+					if options.profileTraining:
+						numImages = len(batchFileNames)
+						stepProfiler.record(time.time() - stepStartTime, numImages, numImages * int(np.prod(results['inputShape'][1:3])), inputWait=inputWaitTime, 
+											compute=(sessRunEndTime - stepStartTime - inputWaitTime), summaries=(summaryEndTime - sessRunEndTime), 
+											imageSaving=(imageSavingTime if isDisplayStep else 0.0))
+						if isDisplayStep:
+							profileStatistics = stepProfiler.getStatistics()
+							print ("Epoch: %d | Iteration: %d | %s" % (epoch, step, stepProfiler.toString(profileStatistics)))
+							if options.tensorboardVisualization:
+								summaryWriter.add_summary(tf.Summary(value=[tf.Summary.Value(tag="profile/" + key, simple_value=value) for key, value in profileStatistics.items()]), global_step=globalStep)
+
+					consumedFileNames += batchFileNames
 					step += 1
 					globalStep += 1
 
+					if (options.saveStep > 0) and (globalStep % options.saveStep == 0):
+						# Save model weights to disk
+						trainingState = {'epoch': epoch, 'step': step, 'globalStep': globalStep, 'randomSeed': options.randomSeed, 
+											'consumedFileNames': [fileName.decode("utf-8") for fileName in consumedFileNames], 'bestModelTracker': bestModelTracker.getState()}
+						checkpointSaver.save(sess, globalStep, trainingState)
+
+					if (options.evaluateStep > 0) and (globalStep % options.evaluateStep == 0):
+						# Lightweight evaluation for model selection
+						averageEvaluateLoss, evaluateMetrics = evaluateModel(sess, evaluateIterator, evaluateHandle)
+						print ("Global step: %d | Evaluation loss: %f | Evaluation mIoU: %f" % (globalStep, averageEvaluateLoss, evaluateMetrics['meanIoU']))
+						if options.tensorboardVisualization:
+							summaryWriter.add_summary(tf.Summary(value=[tf.Summary.Value(tag="evaluate_loss", simple_value=averageEvaluateLoss), 
+														tf.Summary.Value(tag="evaluate_mIoU", simple_value=evaluateMetrics['meanIoU'])]), global_step=globalStep)
+						updateBestModel(averageEvaluateLoss, evaluateMetrics)
+						if bestModelTracker.shouldStop():
+							stopTraining = True
+							break
+
 			except tf.errors.OutOfRangeError:
 				print('Done training for %d epochs, %d steps.' % (epoch, step))
 
-			if step % options.saveStep == 0:
-				# Save model weights to disk
-				outputFileName = os.path.join(options.outputModelDir, options.outputModelName)
-				saver.save(sess, outputFileName)
-				print ("Model saved: %s" % (outputFileName))
+			if options.cacheEncoderFeatures and not useFeatureCache:
+				encoderFeatureCache.finalize(trainFileNames)
+
+			if stopTraining:
+				print ("Early stopping after %d evaluations without improvement" % (bestModelTracker.numEvaluationsWithoutImprovement))
+				break
 
 			# Check the accuracy on validation set
-			sess.run(valIterator.initializer)
+			sess.run([valIterator.initializer, resetConfusionMatrix])
 			averageValLoss = 0.0
 			iterations = 0
 			try:
 				while True:
-					[fileName, originalImage, valLoss, predictedSegMask] = sess.run([inputBatchImageNames, inputBatchImages, loss, predictedMask], feed_dict={datasetSelectionPlaceholder: VAL})
+					[fileName, originalImage, valLoss, predictedSegMask, _] = sess.run([inputBatchImageNames, inputBatchImages, loss, predictedMask, updateConfusionMatrix], feed_dict={datasetHandlePlaceholder: valHandle})
 					
 					# Save image results
-					writeMaskToImage(originalImage, predictedSegMask, options.valImagesOutputDirectory, fileName)
+					if not options.evaluateStepDontSaveImages:
+						maskWriter.write(originalImage, predictedSegMask, options.valImagesOutputDirectory, fileName)
 
 					print ("Iteration: %d | Validation loss: %f" % (iterations, valLoss))
 					averageValLoss += valLoss
@@ -542,49 +1819,84 @@ if options.trainModel:
 			except tf.errors.OutOfRangeError:
 				print('Evaluation on validation set completed!')
 
+			maskWriter.flush()
 			averageValLoss /= iterations
 			print('Average validation loss: %f' % (averageValLoss))
+			valMetrics = computeSegmentationMetrics(sess.run(confusionMatrix))
+			printSegmentationMetrics("Validation", valMetrics)
+			if options.tensorboardVisualization:
+				summaryWriter.add_summary(tf.Summary(value=[tf.Summary.Value(tag="val_mIoU", simple_value=valMetrics['meanIoU']), 
+											tf.Summary.Value(tag="val_pixel_accuracy", simple_value=valMetrics['pixelAccuracy'])]), global_step=globalStep)
+
+			# Model selection at the end of every epoch (reuses the validation pass if evaluating on the complete validation set)
+			if options.evaluateSubsetSize > 0:
+				averageEvaluateLoss, evaluateMetrics = evaluateModel(sess, evaluateIterator, evaluateHandle)
+			else:
+				averageEvaluateLoss, evaluateMetrics = averageValLoss, valMetrics
+			updateBestModel(averageEvaluateLoss, evaluateMetrics)
+
+			if options.cacheParsedSamples:
+				print ("Sample cache | %s" % (sampleCache.getStatistics()))
+
+			if bestModelTracker.shouldStop():
+				print ("Early stopping after %d evaluations without improvement" % (bestModelTracker.numEvaluationsWithoutImprovement))
+				break
+
+		if options.tensorboardVisualization:
+			summaryWriter.close() # Flush the buffered summaries
 
-			# # Check the accuracy on test data
-			# if step % options.saveStepBest == 0:
-			# 	# Report loss on test data
-			# 	[testLoss] = sess.run([loss], feed_dict={inputBatchImages: batchImagesTest, inputBatchLabels: batchLabelsTest, inputKeepProbability: 1.0})
-			# 	print ("Test loss: %f" % testLoss)
-
-			# 	# If its the best loss achieved so far, save the model
-			# 	if testLoss < bestLoss:
-			# 		bestLoss = testLoss
-			# 		# bestModelSaver.save(sess, best_checkpoint_dir + 'checkpoint.data')
-			# 		bestModelSaver.save(sess, checkpointPrefix, global_step=0, latest_filename=checkpointStateName)
-			# 		print ("Best model saved in file: %s" % checkpointPrefix)
-			# 	else:
-			# 		print ("Previous best accuracy: %f" % bestLoss)
-
-		# Save final model weights to disk
+		checkpointSaver.close()
+		bestModelSaver.close()
+		if options.cacheEncoderFeatures:
+			encoderFeatureCache.close()
+
+		# Save final model weights to disk (own checkpoint state file so that the step checkpoints remain subject to their retention policy)
 		outputFileName = os.path.join(options.outputModelDir, options.outputModelName)
-		saver.save(sess, outputFileName)
+		saver.save(sess, outputFileName, latest_filename="checkpoint_final")
 		print ("Model saved: %s" % (outputFileName))
 
 		# Report loss on test data
-		sess.run(testIterator.initializer)
+		sess.run([testIterator.initializer, resetConfusionMatrix])
 		averageTestLoss = 0.0
 		iterations = 0
-		try:
-			while True:
-				[fileName, originalImage, testLoss, predictedSegMask] = sess.run([inputBatchImageNames, inputBatchImages, loss, predictedMask], feed_dict={datasetSelectionPlaceholder: TEST})
-				
+		if options.tiledInference:
+			regLossValue = sess.run(regLoss)
+			testConfusionMatrix = np.zeros((options.numClasses, options.numClasses), dtype=np.int64)
+			for (fileName, originalImage, gtMask), predictedSegLogits in tiledInference(sess, testHandle):
+				predictedSegMask = np.argmax(predictedSegLogits, axis=-1)[:, :, :, np.newaxis]
+				testLoss = computeCrossEntropyLoss(predictedSegLogits, gtMask) + regLossValue
+				testConfusionMatrix += computeConfusionMatrix(predictedSegMask, gtMask)
+
 				# Save image results
-				writeMaskToImage(originalImage, predictedSegMask, options.testImagesOutputDirectory, fileName)
+				maskWriter.write(originalImage, predictedSegMask, options.testImagesOutputDirectory, fileName)
 
 				print ("Iteration: %d | Test loss: %f" % (iterations, testLoss))
 				averageTestLoss += testLoss
 				iterations += 1
 
-		except tf.errors.OutOfRangeError:
 			print('Evaluation on test set completed!')
 
+		else:
+			try:
+				while True:
+					[fileName, originalImage, testLoss, predictedSegMask, _] = sess.run([inputBatchImageNames, inputBatchImages, loss, predictedMask, updateConfusionMatrix], feed_dict={datasetHandlePlaceholder: testHandle})
+					
+					# Save image results
+					maskWriter.write(originalImage, predictedSegMask, options.testImagesOutputDirectory, fileName)
+
+					print ("Iteration: %d | Test loss: %f" % (iterations, testLoss))
+					averageTestLoss += testLoss
+					iterations += 1
+
+			except tf.errors.OutOfRangeError:
+				print('Evaluation on test set completed!')
+
+			testConfusionMatrix = sess.run(confusionMatrix)
+
+		maskWriter.flush()
 		averageTestLoss /= iterations
 		print('Average test loss: %f' % (averageTestLoss))
+		printSegmentationMetrics("Test", computeSegmentationMetrics(testConfusionMatrix))
 
 		print ("Optimization completed!")
 
@@ -605,47 +1917,67 @@ if options.testModel:
 		# # Get reference to placeholders
 		# outputMaskNode = sess.graph.get_tensor_by_name("predictedMasks:0")
 		# lossNode = sess.graph.get_tensor_by_name("Loss/totalLoss:0")
-		# datasetSelectionPlaceholderNode = sess.graph.get_tensor_by_name("DatasetSelectionPlaceholder:0")
+		# datasetHandlePlaceholderNode = sess.graph.get_tensor_by_name("DatasetHandlePlaceholder:0")
 
-		sess.run(testIterator.initializer)
+		testHandle = sess.run(testIteratorHandle)
+		sess.run([testIterator.initializer, resetConfusionMatrix])
 		iterations = 0
 		averageTestLoss = 0.0
-		try:
-			while True:
-				[fileName, originalImage, testLoss, predictedSegMask. predictedSegLogits] = sess.run([inputBatchImageNames, inputBatchImages, loss, predictedMask, predictedLogits], feed_dict={datasetSelectionPlaceholder: TEST})
-
-				# Save image results
-				writeMaskToImage(originalImage, predictedSegMask, options.testImagesOutputDirectory, fileName)
+		testConfusionMatrix = np.zeros((options.numClasses, options.numClasses), dtype=np.int64)
+
+		# Evaluate the images either at once or using tiles
+		if options.tiledInference:
+			regLossValue = sess.run(regLoss)
+			def testResultGenerator():
+				for (fileName, originalImage, gtMask), predictedSegLogits in tiledInference(sess, testHandle):
+					predictedSegMask = np.argmax(predictedSegLogits, axis=-1)[:, :, :, np.newaxis]
+					testLoss = computeCrossEntropyLoss(predictedSegLogits, gtMask) + regLossValue
+					testConfusionMatrix[:] += computeConfusionMatrix(predictedSegMask, gtMask)
+					yield fileName, originalImage, testLoss, predictedSegMask, predictedSegLogits
+		else:
+			def testResultGenerator():
+				try:
+					while True:
+						yield sess.run([inputBatchImageNames, inputBatchImages, loss, predictedMask, predictedLogits, updateConfusionMatrix], feed_dict={datasetHandlePlaceholder: testHandle})[:-1]
+				except tf.errors.OutOfRangeError:
+					testConfusionMatrix[:] = sess.run(confusionMatrix)
+
+		for [fileName, originalImage, testLoss, predictedSegMask, predictedSegLogits] in testResultGenerator():
+			# Save image results
+			maskWriter.write(originalImage, predictedSegMask, options.testImagesOutputDirectory, fileName)
+			
+			if options.useCRFPostProcessing:
+				# TODO: Incorporate dense CRF
+				unary = predictedSegLogits[0]
+				unary = -np.log(unary)
+				unary = unary.transpose(1, 0, 2)
+				w, h, c = unary.shape
+				unary = unary.transpose(1, 0, 2).reshape(options.numClasses, -1)
+				unary = np.ascontiguousarray(unary)
+				resizedImg = np.ascontiguousarray(originalImage[0]).astype(np.uint8)
+
+				d = dcrf.DenseCRF2D(w, h, options.numClasses)
+				d.setUnaryEnergy(unary)
+				d.addPairwiseBilateral(sxy=5, srgb=3, rgbim=resizedImg, compat=1)
+
+				q = d.inference(50)
+				mask = np.argmax(q, axis=0).reshape(w, h).transpose(1, 0)
+				mask = np.array(mask, dtype=np.uint8)[np.newaxis, :, :, np.newaxis]
 				
-				if options.useCRFPostProcessing:
-					# TODO: Incorporate dense CRF
-					unary = predictedSegLogits[0]
-					unary = -np.log(unary)
-					unary = unary.transpose(1, 0, 2)
-					w, h, c = unary.shape
-					unary = unary.transpose(1, 0, 2).reshape(options.numClasses, -1)
-					unary = np.ascontiguousarray(unary)
-					resizedImg = np.ascontiguousarray(originalImage[0]).astype(np.uint8)
-
-					d = dcrf.DenseCRF2D(w, h, options.numClasses)
-					d.setUnaryEnergy(unary)
-					d.addPairwiseBilateral(sxy=5, srgb=3, rgbim=resizedImg, compat=1)
-
-					q = d.inference(50)
-					mask = np.argmax(q, axis=0).reshape(w, h).transpose(1, 0)
-					mask = np.array(mask, dtype=np.uint8)[np.newaxis, :, :, np.newaxis]
-					
-					# Save image results
-					writeMaskToImage(originalImage, mask, options.testImagesOutputDirectory, fileName, append='-crf')
+				# Save image results
+				maskWriter.write(originalImage, mask, options.testImagesOutputDirectory, fileName, append='-crf')
 
-				print ("Iteration: %d | Test loss: %f" % (iterations, testLoss))
-				averageTestLoss += testLoss
-				iterations += 1
+			print ("Iteration: %d | Test loss: %f" % (iterations, testLoss))
+			averageTestLoss += testLoss
+			iterations += 1
 
-		except tf.errors.OutOfRangeError:
-			print('Evluation on test set completed!')
+		print('Evaluation on test set completed!')
 
+		maskWriter.flush()
 		averageTestLoss /= iterations
 		print('Average test loss: %f' % (averageTestLoss))
+		printSegmentationMetrics("Test", computeSegmentationMetrics(testConfusionMatrix))
 
 	print ("Model evaluation completed!")
+
+maskWriter.close()
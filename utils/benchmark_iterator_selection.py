@@ -0,0 +1,67 @@
+import time
+from optparse import OptionParser
+
+import tensorflow as tf
+
+TRAIN = 0
+VAL = 1
+TEST = 2
+
+# Small synthetic dataset so that the measured time is dominated by the per-step overhead
+def createDataset(options):
+	img = tf.zeros([options.imageSize, options.imageSize, 3], dtype=tf.float32)
+	mask = tf.zeros([options.imageSize, options.imageSize, 1], dtype=tf.int32)
+	dataset = tf.data.Dataset.from_tensors((tf.constant("image.jpg"), img, mask)).repeat()
+	return dataset.batch(1).prefetch(2)
+
+def timeSteps(sess, op, numSteps, feedDict=None):
+	for _ in range(10): # Warmup
+		sess.run(op, feed_dict=feedDict)
+
+	startTime = time.time()
+	for _ in range(numSteps):
+		sess.run(op, feed_dict=feedDict)
+	return (time.time() - startTime) / numSteps
+
+# Previous input graph: nested tf.cond over three iterators selected via a fed placeholder
+def benchmarkCondSelection(options):
+	with tf.Graph().as_default():
+		iterators = [createDataset(options).make_initializable_iterator() for _ in range(3)]
+		datasetSelectionPlaceholder = tf.placeholder(dtype=tf.int32, shape=(), name='DatasetSelectionPlaceholder')
+		_, images, masks = tf.cond(tf.equal(datasetSelectionPlaceholder, TRAIN), lambda: iterators[TRAIN].get_next(), 
+									lambda: tf.cond(tf.equal(datasetSelectionPlaceholder, VAL), lambda: iterators[VAL].get_next(), lambda: iterators[TEST].get_next()))
+		op = tf.reduce_sum(images) + tf.to_float(tf.reduce_sum(masks))
+
+		with tf.Session() as sess:
+			sess.run([iterator.initializer for iterator in iterators])
+			return timeSteps(sess, op, options.numSteps, feedDict={datasetSelectionPlaceholder: TRAIN})
+
+# Current input graph: feedable iterator which defaults to the train iterator handle
+def benchmarkHandleSelection(options):
+	with tf.Graph().as_default():
+		iterators = [createDataset(options).make_initializable_iterator() for _ in range(3)]
+		datasetHandlePlaceholder = tf.placeholder_with_default(iterators[TRAIN].string_handle(), shape=(), name='DatasetHandlePlaceholder')
+		inputIterator = tf.data.Iterator.from_string_handle(datasetHandlePlaceholder, iterators[TRAIN].output_types, iterators[TRAIN].output_shapes)
+		_, images, masks = inputIterator.get_next()
+		op = tf.reduce_sum(images) + tf.to_float(tf.reduce_sum(masks))
+
+		with tf.Session() as sess:
+			sess.run([iterator.initializer for iterator in iterators])
+			return timeSteps(sess, op, options.numSteps)
+
+if __name__ == "__main__":
+
+	# Command line options
+	parser = OptionParser()
+	parser.add_option("--numSteps", action="store", type="int", dest="numSteps", default=1000, help="Number of steps to be timed")
+	parser.add_option("--imageSize", action="store", type="int", dest="imageSize", default=32, help="Size of the synthetic images")
+
+	# Parse command line options
+	(options, args) = parser.parse_args()
+
+	condStepTime = benchmarkCondSelection(options)
+	handleStepTime = benchmarkHandleSelection(options)
+
+	print ("tf.cond selection with feed_dict: %.3f ms/step" % (condStepTime * 1000.0))
+	print ("Feedable iterator handle without feed_dict: %.3f ms/step" % (handleStepTime * 1000.0))
+	print ("Overhead reduction: %.3f ms/step (%.1f%%)" % ((condStepTime - handleStepTime) * 1000.0, 100.0 * (condStepTime - handleStepTime) / condStepTime))
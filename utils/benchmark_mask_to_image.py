@@ -0,0 +1,61 @@
+import time
+from optparse import OptionParser
+
+import cv2
+import numpy as np
+
+COLORS = np.array([[0, 0, 0], [0, 128, 0], [0, 0, 128], [192, 224, 224]]) # RGB
+LABELS = np.array([0, 1, 1, 2])
+
+PALETTE = np.zeros((256, 3), dtype=np.uint8)
+for color, label in zip(COLORS, LABELS):
+	PALETTE[label] = color
+
+# Previous implementation: boolean map and three fancy-indexed assignments per class into a float32 buffer
+def maskToImageLoop(img, mask):
+	rgbMask = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.float32)
+	for color, label in zip(COLORS, LABELS):
+		binaryMap = mask[:, :, 0] == label
+		rgbMask[binaryMap, 0] = color[0]
+		rgbMask[binaryMap, 1] = color[1]
+		rgbMask[binaryMap, 2] = color[2]
+
+	return np.uint8(cv2.addWeighted(img.astype(np.float32), 0.5, rgbMask, 0.5, 0.0))
+
+# Current implementation: palette lookup table with in-place uint8 blending
+def maskToImageLUT(img, mask):
+	rgbMask = np.take(PALETTE, mask[:, :, 0], axis=0, mode='clip')
+	cv2.addWeighted(img.astype(np.uint8), 0.5, rgbMask, 0.5, 0.0, dst=rgbMask)
+	return rgbMask
+
+def timeFunction(function, img, mask, numIterations):
+	function(img, mask) # Warmup
+	startTime = time.time()
+	for _ in range(numIterations):
+		function(img, mask)
+	return (time.time() - startTime) / numIterations
+
+if __name__ == "__main__":
+
+	# Command line options
+	parser = OptionParser()
+	parser.add_option("--imageSize", action="store", type="int", dest="imageSize", default=2048, help="Height and width of the synthetic image")
+	parser.add_option("--numClasses", action="store", type="int", dest="numClasses", default=3, help="Number of classes")
+	parser.add_option("--numIterations", action="store", type="int", dest="numIterations", default=20, help="Number of timed iterations")
+
+	# Parse command line options
+	(options, args) = parser.parse_args()
+
+	# Network outputs: float32 image and int64 mask (argmax)
+	img = np.random.uniform(0.0, 255.0, size=(options.imageSize, options.imageSize, 3)).astype(np.float32)
+	mask = np.random.randint(0, options.numClasses, size=(options.imageSize, options.imageSize, 1)).astype(np.int64)
+
+	maxDifference = np.max(np.abs(maskToImageLoop(img, mask).astype(np.int32) - maskToImageLUT(img, mask).astype(np.int32)))
+	print ("Maximum difference between the outputs: %d (rounding instead of truncation)" % (maxDifference))
+
+	loopTime = timeFunction(maskToImageLoop, img, mask, options.numIterations)
+	lutTime = timeFunction(maskToImageLUT, img, mask, options.numIterations)
+	print ("Image size: %dx%d" % (options.imageSize, options.imageSize))
+	print ("Per-class loop: %.2f ms" % (loopTime * 1000.0))
+	print ("Lookup table: %.2f ms" % (lutTime * 1000.0))
+	print ("Speedup: %.2fx" % (loopTime / lutTime))
@@ -0,0 +1,83 @@
+import time
+from optparse import OptionParser
+
+import numpy as np
+import tensorflow as tf
+
+# Aspect preserving sizes as produced by the input pipeline (the larger dimension is fixed)
+def sampleImageSizes(options):
+	randomState = np.random.RandomState(0)
+	smallerSizes = randomState.randint(options.imageSize // 2, options.imageSize + 1, size=options.numSteps + options.numWarmupSteps)
+	return [(options.imageSize, smallerSize) if randomState.rand() < 0.5 else (smallerSize, options.imageSize) for smallerSize in smallerSizes]
+
+def snapToMultiple(size, multiple):
+	return ((size + multiple - 1) // multiple) * multiple
+
+# Small encoder-decoder with the same structure as the FCN (strided convolutions, 'valid' transposed convolutions and a resize to the input size)
+def createTrainOp(useXLA):
+	images = tf.placeholder(dtype=tf.float32, shape=[1, None, None, 3])
+	masks = tf.placeholder(dtype=tf.int32, shape=[1, None, None])
+	scope = tf.contrib.compiler.jit.experimental_jit_scope() if useXLA else tf.name_scope('Model')
+	with scope:
+		out = images
+		for numFilters in [32, 64, 128, 256]:
+			out = tf.layers.conv2d(out, numFilters, (3, 3), strides=(2, 2), padding='same', activation=tf.nn.relu)
+		for numFilters in [128, 64, 32, 32]:
+			out = tf.layers.conv2d_transpose(out, numFilters, (3, 3), strides=(2, 2), padding='valid', activation=tf.nn.relu)
+		out = tf.image.resize_bilinear(out, tf.shape(images)[1:3], align_corners=True)
+		logits = tf.layers.conv2d(out, 3, (3, 3), padding='same')
+
+	weights = tf.to_float(tf.not_equal(masks, 255)) # Padded pixels are ignored
+	loss = tf.losses.sparse_softmax_cross_entropy(labels=tf.where(tf.equal(masks, 255), tf.zeros_like(masks), masks), logits=logits, weights=weights)
+	return images, masks, tf.train.AdamOptimizer(1e-4).minimize(loss)
+
+def timeTraining(options, imageSizes, multiple=0, useXLA=False):
+	with tf.Graph().as_default():
+		images, masks, trainOp = createTrainOp(useXLA)
+		config = tf.ConfigProto()
+		config.gpu_options.allow_growth = True
+		with tf.Session(config=config) as sess:
+			sess.run(tf.global_variables_initializer())
+
+			def runStep(height, width):
+				paddedHeight, paddedWidth = (snapToMultiple(height, multiple), snapToMultiple(width, multiple)) if multiple > 0 else (height, width)
+				img = np.zeros([1, paddedHeight, paddedWidth, 3], dtype=np.float32)
+				mask = np.full([1, paddedHeight, paddedWidth], 255, dtype=np.int32)
+				img[:, :height, :width] = np.random.rand(height, width, 3)
+				mask[:, :height, :width] = 0
+				sess.run(trainOp, feed_dict={images: img, masks: mask})
+
+			# Warmup (compilations and autotuning for the canonical shapes)
+			warmupSizes = imageSizes[:options.numWarmupSteps]
+			if multiple > 0:
+				warmupSizes = sorted(set([(snapToMultiple(height, multiple), snapToMultiple(width, multiple)) for height, width in imageSizes]))
+			startTime = time.time()
+			for height, width in warmupSizes:
+				runStep(height, width)
+			warmupTime = time.time() - startTime
+
+			startTime = time.time()
+			for height, width in imageSizes[options.numWarmupSteps:]:
+				runStep(height, width)
+			return warmupTime, (time.time() - startTime) / options.numSteps, len(warmupSizes)
+
+if __name__ == "__main__":
+
+	# Command line options
+	parser = OptionParser()
+	parser.add_option("--numSteps", action="store", type="int", dest="numSteps", default=200, help="Number of steps to be timed")
+	parser.add_option("--numWarmupSteps", action="store", type="int", dest="numWarmupSteps", default=10, help="Number of warmup steps for the dynamic shape path")
+	parser.add_option("--imageSize", action="store", type="int", dest="imageSize", default=512, help="Size of the larger image dimension")
+	parser.add_option("--canonicalShapeMultiple", action="store", type="int", dest="canonicalShapeMultiple", default=32, help="Multiple to which the image dimensions are padded")
+
+	# Parse command line options
+	(options, args) = parser.parse_args()
+
+	imageSizes = sampleImageSizes(options)
+	results = [("Dynamic shapes", timeTraining(options, imageSizes)),
+				("Canonical shapes", timeTraining(options, imageSizes, multiple=options.canonicalShapeMultiple)),
+				("Canonical shapes + XLA", timeTraining(options, imageSizes, multiple=options.canonicalShapeMultiple, useXLA=True))]
+
+	for name, (warmupTime, stepTime, numWarmupSteps) in results:
+		print ("%s: %.3f ms/step (warmup: %.2f sec for %d steps)" % (name, stepTime * 1000.0, warmupTime, numWarmupSteps))
+	print ("Speedup (canonical shapes + XLA): %.2fx" % (results[0][1][1] / results[2][1][1]))
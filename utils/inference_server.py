@@ -0,0 +1,193 @@
+import os
+import time
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+
+import queue
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+# Collects concurrent requests and runs them through the network as a single batch
+class DynamicBatcher(object):
+	def __init__(self, sess, inputTensor, outputTensor, maxBatchSize, maxLatency):
+		self.sess = sess
+		self.inputTensor = inputTensor
+		self.outputTensor = outputTensor
+		self.maxBatchSize = maxBatchSize
+		self.maxLatency = maxLatency
+		self.requestQueue = queue.Queue()
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	# Blocks until the mask for the given image ([H, W, C]) has been computed
+	def predict(self, img):
+		request = {'image': img, 'mask': None, 'error': None, 'done': threading.Event()}
+		self.requestQueue.put(request)
+		request['done'].wait()
+		if request['error'] is not None:
+			raise request['error']
+		return request['mask']
+
+	def run(self):
+		while True:
+			# Wait for the first request and then collect more until the batch is full or the latency budget is exhausted
+			requests = [self.requestQueue.get()]
+			deadline = time.time() + self.maxLatency
+			while len(requests) < self.maxBatchSize:
+				remainingTime = deadline - time.time()
+				if remainingTime <= 0:
+					break
+				try:
+					requests.append(self.requestQueue.get(timeout=remainingTime))
+				except queue.Empty:
+					break
+
+			self.processBatch(requests)
+
+	def processBatch(self, requests):
+		# Images of different sizes are zero padded to the largest image in the batch
+		maxHeight = max([request['image'].shape[0] for request in requests])
+		maxWidth = max([request['image'].shape[1] for request in requests])
+		batch = np.zeros((len(requests), maxHeight, maxWidth, requests[0]['image'].shape[2]), dtype=np.float32)
+		for idx, request in enumerate(requests):
+			batch[idx, :request['image'].shape[0], :request['image'].shape[1]] = request['image']
+
+		try:
+			masks = self.sess.run(self.outputTensor, feed_dict={self.inputTensor: batch})
+			for idx, request in enumerate(requests):
+				request['mask'] = masks[idx, :request['image'].shape[0], :request['image'].shape[1], 0].astype(np.uint8)
+		except Exception as e:
+			for request in requests:
+				request['error'] = e
+
+		print ("Processed batch of size %d (%dx%d)" % (len(requests), maxHeight, maxWidth))
+		for request in requests:
+			request['done'].set()
+
+def loadFrozenGraph(options):
+	graphDef = tf.GraphDef()
+	with tf.gfile.GFile(options.frozenGraph, "rb") as f:
+		graphDef.ParseFromString(f.read())
+
+	graph = tf.Graph()
+	with graph.as_default():
+		tf.import_graph_def(graphDef, name="")
+
+	config = tf.ConfigProto()
+	config.gpu_options.allow_growth = True
+	sess = tf.Session(graph=graph, config=config)
+	return sess, graph.get_tensor_by_name(options.inputTensorName), graph.get_tensor_by_name(options.outputTensorName)
+
+# Same aspect aware scaling as used during training
+def preprocessImage(imageBytes, maxImageSize):
+	try:
+		img = cv2.imdecode(np.frombuffer(imageBytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+	except cv2.error: # Raised instead of returning None for some malformed inputs
+		return None
+	if img is None:
+		return None
+	img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) # Network is trained on RGB images
+	scale = float(maxImageSize) / max(img.shape[0], img.shape[1])
+	resizedImg = cv2.resize(img, (max(int(round(img.shape[1] * scale)), 1), max(int(round(img.shape[0] * scale)), 1)), interpolation=cv2.INTER_LINEAR) # Extreme aspect ratios keep at least one pixel
+	return img.shape, resizedImg.astype(np.float32)
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+	def address_string(self):
+		return str(self.client_address[0]) if self.client_address else "unix-socket"
+
+	def sendResponse(self, code, contentType, body):
+		self.send_response(code)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if self.path == "/health":
+			self.sendResponse(200, "text/plain", b"OK")
+		else:
+			self.sendResponse(404, "text/plain", b"Not found")
+
+	# Expects the encoded image (JPEG/PNG) as the request body and returns the predicted mask as PNG (pixel value = class label)
+	def do_POST(self):
+		if self.path != "/predict":
+			self.sendResponse(404, "text/plain", b"Not found")
+			return
+
+		try:
+			contentLength = int(self.headers.get("Content-Length", 0))
+		except ValueError:
+			contentLength = 0
+		if contentLength <= 0:
+			self.sendResponse(400, "text/plain", b"Missing image in request body")
+			return
+
+		imageBytes = self.rfile.read(contentLength)
+		result = preprocessImage(imageBytes, self.server.options.maxImageSize)
+		if result is None:
+			self.sendResponse(400, "text/plain", b"Unable to decode image")
+			return
+		originalShape, img = result
+
+		try:
+			mask = self.server.batcher.predict(img)
+		except Exception as e:
+			self.sendResponse(500, "text/plain", str(e).encode("utf-8"))
+			return
+
+		mask = cv2.resize(mask, (originalShape[1], originalShape[0]), interpolation=cv2.INTER_NEAREST) # Back to the original resolution
+		self.sendResponse(200, "image/png", cv2.imencode(".png", mask)[1].tobytes())
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+if __name__ == "__main__":
+
+	# Command line options
+	parser = OptionParser()
+	parser.add_option("--frozenGraph", action="store", type="string", dest="frozenGraph", default="./output/frozen_graph.pb", help="Frozen graph (see freeze_graph.py with --output_node_names=predictedMasks)")
+	parser.add_option("--inputTensorName", action="store", type="string", dest="inputTensorName", default="inputBatchImages:0", help="Name of the input image tensor")
+	parser.add_option("--outputTensorName", action="store", type="string", dest="outputTensorName", default="predictedMasks:0", help="Name of the output mask tensor")
+	parser.add_option("--maxImageSize", action="store", type="int", dest="maxImageSize", default=2048, help="Maximum size of the larger dimension while preserving aspect ratio")
+	parser.add_option("--maxBatchSize", action="store", type="int", dest="maxBatchSize", default=8, help="Maximum number of requests processed together")
+	parser.add_option("--maxLatencyMs", action="store", type="float", dest="maxLatencyMs", default=20.0, help="Maximum time to wait for more requests before processing a batch")
+	parser.add_option("--host", action="store", type="string", dest="host", default="127.0.0.1", help="Host to bind the HTTP server")
+	parser.add_option("--port", action="store", type="int", dest="port", default=8500, help="Port to bind the HTTP server")
+	parser.add_option("--unixSocket", action="store", type="string", dest="unixSocket", default="", help="Serve on the given Unix socket instead of TCP")
+
+	# Parse command line options
+	(options, args) = parser.parse_args()
+	print (options)
+
+	sess, inputTensor, outputTensor = loadFrozenGraph(options)
+	print ("Frozen graph loaded: %s" % (options.frozenGraph))
+
+	if options.unixSocket != "":
+		if os.path.exists(options.unixSocket):
+			os.remove(options.unixSocket)
+		server = ThreadingUnixHTTPServer(options.unixSocket, InferenceRequestHandler)
+		print ("Serving on Unix socket: %s" % (options.unixSocket))
+	else:
+		server = ThreadingHTTPServer((options.host, options.port), InferenceRequestHandler)
+		print ("Serving on http://%s:%d" % (options.host, options.port))
+
+	server.options = options
+	server.batcher = DynamicBatcher(sess, inputTensor, outputTensor, options.maxBatchSize, options.maxLatencyMs / 1000.0)
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+	server.server_close()
+	sess.close()
+	print ("Done")